@@ -296,34 +296,57 @@ export function Quiz({ questionData, isExamMode, onContinue }) {
 
 
 
+const prefetchedMedia = new Set();
+
+function prefetchMedia(upcomingMedia) {
+  for (const { media_name } of upcomingMedia) {
+    if (getMediaType(media_name) == "NOMEDIA" || prefetchedMedia.has(media_name)) continue;
+    prefetchedMedia.add(media_name);
+
+    const link = document.createElement("link");
+    link.rel = "prefetch";
+    link.href = import.meta.env.VITE_API + "media/" + media_name;
+    document.head.appendChild(link);
+  }
+}
+
 function sessionConnectionHandler(mode, setQuestionData, setIsNextQuestionAnim, setExamResult) {
   if (mode !== "exam" && mode !== "practice") {
     throw new Error(`Invalid connection mode: ${mode} use 'exam' or 'practice'`);
   }
   
   const clientId = localStorage.getItem("client_id") || "anon";
-  const ws = new WebSocket(import.meta.env.VITE_API + "ws/" + mode + "/" + clientId);
-
-  ws.onmessage = (ev) => {
-    console.log(ev)
-    const { event, content } = JSON.parse(ev.data);
+  // Pipeline mode: ANSWER_VALIDATION already carries the next question, no GET_QUESTION round trip.
+  const ws = new WebSocket(import.meta.env.VITE_API + "ws/" + mode + "/" + clientId + "?pipeline=true");
 
+  function handleMessage({ event, content }) {
     if (event == "QUESTION_DATA") {
       setQuestionData(content)
       setIsNextQuestionAnim(false);
     }
 
+    if (event == "MEDIA_PREFETCH") {
+      prefetchMedia(content)
+    }
+
     if (event == "SET_CLIENT_ID") {
       localStorage.setItem("client_id", content);
     }
 
     if (event == "ANSWER_VALIDATION") {
-      if (content == "OK" || content.is_correct) {
-        ws.send(JSON.stringify({ "event": "GET_QUESTION", "content": null }))
+      const { validation, next } = content;
+      if (validation == "OK" || validation.is_correct) {
+        handleMessage(next)
       } else {
-        document.getElementById("possible-answer-" + content.correct_answer).style.backgroundColor = 'green';
-        document.getElementById("possible-answer-" + content.given_answer).style.setProperty("background-color", "red", "important");
-        setTimeout(() => { ws.send(JSON.stringify({ "event": "GET_QUESTION", "content": null })) }, 3000)
+        document.getElementById("possible-answer-" + validation.correct_answer).style.backgroundColor = 'green';
+        document.getElementById("possible-answer-" + validation.given_answer).style.setProperty("background-color", "red", "important");
+        setTimeout(() => {
+          handleMessage(next)
+          // The answering time is measured from now, not from when the question was received.
+          if (next.event == "QUESTION_DATA") {
+            ws.send(JSON.stringify({ "event": "QUESTION_SHOWN", "content": null }))
+          }
+        }, 3000)
         setIsNextQuestionAnim(true);
       }
     }
@@ -333,6 +356,11 @@ function sessionConnectionHandler(mode, setQuestionData, setIsNextQuestionAnim,
     }
   }
 
+  ws.onmessage = (ev) => {
+    console.log(ev)
+    handleMessage(JSON.parse(ev.data));
+  }
+
   ws.onopen = (ev) => {
     console.log("OPEN")
     ws.send(JSON.stringify({ "event": "GET_QUESTION", "content": null }))
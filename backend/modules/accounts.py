@@ -1,14 +1,40 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from datetime import datetime
 from pydantic import BaseModel
 from hashlib import sha1
+import asyncio
 import base64
 import bcrypt
 import random
+import time
 import uuid
+import os
 
+from modules.models import Client, CLIENT_AUTH_COLUMNS
+from modules.sessions import session_backend
 from modules import observability
 from modules import database
 
 
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS") or 12)  # Cost factor of new hashes.
+BCRYPT_MAX_WORKERS = int(os.environ.get("BCRYPT_MAX_WORKERS") or 2)  # Concurrent hashing/verification cap.
+
+SESSION_CACHE_TTL = float(os.environ.get("SESSION_CACHE_TTL") or 60)  # Seconds.
+SESSION_CACHE_MAX_CLIENTS = int(os.environ.get("SESSION_CACHE_MAX_CLIENTS") or 10_000)
+
+USERNAME_INDEX_PAGE_SIZE = 1000
+
+# bcrypt releases the GIL, so the event loop keeps serving other clients while passwords are being hashed.
+_bcrypt_executor = ThreadPoolExecutor(max_workers=BCRYPT_MAX_WORKERS, thread_name_prefix="bcrypt")
+
+# client_id: {iphash: (expires_at, username)} of validated sessions, invalidations are broadcast to the other workers.
+_session_cache: OrderedDict[str, dict[str, tuple[float, str]]] = OrderedDict()
+
+# Names of all registered accounts, None until `load_username_index()` succeeds.
+_username_index: set[str] | None = None
+
+
 class AccountRegisterModel(BaseModel):
     client_id: str = ""
     username: str
@@ -30,6 +56,25 @@ def is_valid_uuid4(uuid_string: str) -> bool:
 def hash_ip(raw_ip: str) -> str:
     return sha1(raw_ip.encode()).hexdigest()
 
+async def __run_bcrypt(func, *args):
+    queued_at = time.perf_counter()
+    
+    def job():
+        observability.BCRYPT_WAIT_TIME.observe(time.perf_counter() - queued_at)
+        return func(*args)
+    
+    observability.BCRYPT_QUEUED.inc()
+    future = _bcrypt_executor.submit(job)
+    future.add_done_callback(lambda _: observability.BCRYPT_QUEUED.dec())  # Also if cancelled (with the caller) before it started.
+    return await asyncio.wrap_future(future)
+
+async def hash_password(password: str) -> str:
+    encrypted_password = await __run_bcrypt(bcrypt.hashpw, password.encode(), bcrypt.gensalt(BCRYPT_ROUNDS))
+    return base64.b64encode(encrypted_password).decode()
+
+async def check_password(password: str, hashed_password: str) -> bool:
+    return await __run_bcrypt(bcrypt.checkpw, password.encode(), base64.b64decode(hashed_password))
+
 async def create_anonymous_client() -> str:
     client_id = str(uuid.uuid4())
     await database.execute_query(database.supabase.table("Clients").insert({
@@ -40,43 +85,139 @@ async def create_anonymous_client() -> str:
 
     return client_id
 
-async def get_client_by_id(client_id: str) -> dict | None:
+async def get_client_by_id(client_id: str, columns: str) -> Client | None:
+    """ `columns` - comma separated projection, must include `client_id`. """
     if not client_id or not is_valid_uuid4(client_id):
         return
     
-    query = await database.execute_query(database.supabase.table("Clients").select("*").eq("client_id", client_id))
-    if not query:
+    query = await database.execute_query(database.supabase.table("Clients").select(columns).eq("client_id", client_id))
+    if not query or not query.data:
         return
+    return Client.from_row(query.data[0])
+
+async def get_client_by_name(username: str, columns: str = "client_id") -> Client | None:
+    query = await database.execute_query(database.supabase.table("Clients").select(columns).eq("name", username))
+    if query and query.data:
+        return Client.from_row(query.data[0])
     
-    clients_data = query.model_dump()["data"]
-    if not clients_data:
-        return
-    return clients_data[0]
+async def load_username_index() -> bool:
+    """ Load names of all registered accounts. Keeps the previous index on failure. """
+    global _username_index
+    
+    username_index = set()
+    page_start = 0
+    while True:
+        query = database.supabase.table("Clients").select("name").not_.is_("name", "null").range(page_start, page_start + USERNAME_INDEX_PAGE_SIZE - 1)
+        response = await database.execute_query(query)
+        if response is None:
+            observability.db_logger.error(f"Failed to load username index page_start={page_start}")
+            return False
+        
+        username_index.update(row["name"] for row in response.data)
+        if len(response.data) < USERNAME_INDEX_PAGE_SIZE:
+            break
+        page_start += USERNAME_INDEX_PAGE_SIZE
+    
+    _username_index = username_index
+    observability.db_logger.info(f"Loaded username index with total_usernames={len(username_index)}")
+    return True
 
-async def get_client_by_name(username: str) -> dict | None:
-    query = await database.execute_query(database.supabase.table("Clients").select("*").eq("name", username))
-    data = query.model_dump()["data"]
-    if data:
-        return data[0]
+async def username_exists(username: str, confirm_missing: bool = False) -> bool:
+    """
+    Usernames missing from the index are free without a DB query, hits are confirmed in the DB.
+    `confirm_missing` - query the DB for the missing ones too (other workers' registrations are not in this index).
+    """
+    if _username_index is not None and username not in _username_index and not confirm_missing:
+        observability.USERNAME_INDEX_NEGATIVES.inc()
+        return False
     
-def get_all_anon_and_test_clients() -> list[dict]:
-    query = database._sync_supabase.table("Clients").select("*").or_("is_anon.eq.true,name.ilike.test%").execute()
-    return query.model_dump()["data"]
+    if await get_client_by_name(username) is not None:
+        if _username_index is not None:
+            _username_index.add(username)
+        return True
+    
+    if _username_index is not None:  # Stale entry, e.g. the account was removed by another process.
+        _username_index.discard(username)
+    return False
+
+async def get_abandoned_client_ids(
+    created_before: datetime,
+    max_practice_index: int,
+    client_ids: list[str] | None = None,
+    excluded_client_ids: list[str] | None = None,
+    after_client_id: str | None = None,
+    limit: int = 1000
+) -> list[str]:
+    """
+    IDs (ordered) of accounts created before `created_before` with `practice_index` below `max_practice_index`.
+    Only anonymous and test accounts are considered, unless the candidates are narrowed down with `client_ids`.
+    Pages are continued with the last returned ID as `after_client_id` (keyset pagination).
+    """
+    query = database.supabase.table("Clients").select("client_id").lt("created_at", created_before.isoformat()).lt("practice_index", max_practice_index)
+    if client_ids is None:
+        query = query.or_("is_anon.eq.true,name.ilike.test%")
+    else:
+        query = query.in_("client_id", client_ids)
+    
+    if excluded_client_ids:
+        query = query.not_.in_("client_id", excluded_client_ids)
+    if after_client_id is not None:
+        query = query.gt("client_id", after_client_id)
+    
+    response = await database.execute_query(query.order("client_id").limit(limit))
+    if response is None:
+        return []
+    return [row["client_id"] for row in response.data]
+
+def drop_cached_sessions(client_ids: list[str]) -> None:
+    for client_id in client_ids:
+        _session_cache.pop(client_id, None)
+
+async def invalidate_sessions(client_ids: list[str]) -> None:
+    """ Drop cached session validations of the clients in this and (through the `session_backend`) the other workers. """
+    drop_cached_sessions(client_ids)
+    await session_backend.invalidate(client_ids)
+
+def __cache_session(client_id: str, iphash: str, username: str) -> None:
+    _session_cache.setdefault(client_id, {})[iphash] = (time.time() + SESSION_CACHE_TTL, username)
+    _session_cache.move_to_end(client_id)
+    if len(_session_cache) > SESSION_CACHE_MAX_CLIENTS:
+        _session_cache.popitem(last=False)
+
+async def validate_session(client_id: str, iphash: str) -> str | None:
+    """ Username of the account if `iphash` is logged into it, None otherwise. """
+    cached_session = _session_cache.get(client_id, {}).get(iphash)
+    if cached_session is not None and cached_session[0] > time.time():
+        observability.SESSION_CACHE_HITS.inc()
+        return cached_session[1]
+    
+    observability.SESSION_CACHE_MISSES.inc()
+    account = await get_client_by_id(client_id, "client_id,name,logged_ips")
+    
+    if account is None:
+        observability.client_logger.warning(f"session validation failed for client_id={client_id} by iphash={iphash} (account not found)")
+        return
+    
+    if iphash not in account.logged_ips:
+        observability.client_logger.warning(f"session validation failed for client_id={client_id} by iphash={iphash}")
+        return
+    
+    __cache_session(client_id, iphash, account.name)
+    return account.name
 
 async def register_account(client_id: str, username: str, password: str, iphash: str) -> bool | str:
-    anon_client_entry = await get_client_by_id(client_id)
+    anon_client_entry = await get_client_by_id(client_id, "client_id,is_anon")
     if anon_client_entry is None:
         observability.client_logger.warning(f"failed to register account client_id={client_id} (not found) - creating anon account and then migrating...")
         client_id = await create_anonymous_client()
-        anon_client_entry = await get_client_by_id(client_id)
+        anon_client_entry = await get_client_by_id(client_id, "client_id,is_anon")
         observability.client_logger.info(f"created anonymous account in order to register user client_id={client_id} username={username} iphash={iphash}")
     
-    if not anon_client_entry["is_anon"]:
+    if not anon_client_entry.is_anon:
         observability.client_logger.error(f"failed to register account client_id={client_id} (account not anon?)")
         return False
     
-    encrypted_password = bcrypt.hashpw(password.encode(), bcrypt.gensalt())
-    hashed_password = base64.b64encode(encrypted_password).decode()
+    hashed_password = await hash_password(password)
     
     await database.execute_query(
         database.supabase.table("Clients").update({
@@ -87,62 +228,84 @@ async def register_account(client_id: str, username: str, password: str, iphash:
         }).eq("client_id", client_id)
     )
     
+    await invalidate_sessions([client_id])
+    if _username_index is not None:
+        _username_index.add(username)
     observability.client_logger.info(f"successfully registered account client_id={client_id} with username={username} from iphash={iphash}")
     return client_id
 
-async def login_account(username: str, password: str, iphash: str) -> bool:
-    account = await get_client_by_name(username)
+async def login_account(username: str, password: str, iphash: str) -> str | None:
+    """ client_id of the account on success, None otherwise. """
+    account = await get_client_by_name(username, CLIENT_AUTH_COLUMNS)
     if account is None:
         observability.client_logger.error(f"failed to login into account username={username} (not found)")
-        return False
+        return
     
-    if not bcrypt.checkpw(password.encode(), base64.b64decode(account['password'])):
+    if not await check_password(password, account.password):
         observability.client_logger.error(f"failed to login into account username={username} (invalid password)")
-        return False
+        return
 
-    if iphash not in account['logged_ips']:
+    if iphash not in account.logged_ips:
         await database.execute_query(
             database.supabase.table("Clients").update({
-                "logged_ips": account['logged_ips'] + [iphash]
-            }).eq("client_id", account['client_id'])
+                "logged_ips": account.logged_ips + [iphash]
+            }).eq("client_id", account.client_id)
         )
-        observability.client_logger.info(f"added iphash={iphash} to logged_ips of client_id={account['client_id']}")
+        observability.client_logger.info(f"added iphash={iphash} to logged_ips of client_id={account.client_id}")
         
-    observability.client_logger.info(f"successfully logged in into account client_id={account['client_id']} from iphash={iphash}")
-    return True
+    await invalidate_sessions([account.client_id])
+    observability.client_logger.info(f"successfully logged in into account client_id={account.client_id} from iphash={iphash}")
+    return account.client_id
 
 async def logout(client_id: str, iphash: str) -> None:
-    account = await get_client_by_id(client_id)
+    account = await get_client_by_id(client_id, "client_id,logged_ips")
     if account is None:
         return observability.client_logger.error(f"failed to logout iphash={iphash} from account client_id={client_id} (not found)")
         
-    if iphash not in account['logged_ips']:
+    if iphash not in account.logged_ips:
         return observability.client_logger.error(f"failed to logout iphash={iphash} from account client_id={client_id} (iphash not logged?)")
         
-    account['logged_ips'].remove(iphash)
+    account.logged_ips.remove(iphash)
     await database.execute_query(
         database.supabase.table("Clients").update({
-            "logged_ips": account['logged_ips']
-        }).eq("client_id", account['client_id'])
+            "logged_ips": account.logged_ips
+        }).eq("client_id", account.client_id)
     )
     
+    await invalidate_sessions([client_id])
     observability.client_logger.info(f"logged out iphash={iphash} from account client_id={client_id}")
     
 async def fetch_data(client_id: str, iphash: str) -> tuple[bool, dict | str]:
-    account = await get_client_by_id(client_id)
+    account = await get_client_by_id(client_id, "client_id,logged_ips")
     if account is None:
         observability.client_logger.error(f"failed to fetch account data by iphash={iphash} from account client_id={client_id} (not found)")
         return (False, "Nie znaleziono konta.")
         
-    if iphash not in account['logged_ips']:
+    if iphash not in account.logged_ips:
         observability.client_logger.error(f"failed to fetch account data by iphash={iphash} from account client_id={client_id} (iphash not logged)")
         return (False, "Brak dostępu.")
 
-def remove_account(client_id: str) -> None:    
-    if not is_valid_uuid4(client_id):
-        return observability.db_logger.error(f"Cannot proceed removing account with client_id={client_id} (not valid UUID4)")
+async def remove_accounts(client_ids: list[str]) -> list[str]:
+    """ Delete the accounts in a single query, returns IDs of the removed ones. """
+    valid_client_ids = [client_id for client_id in client_ids if is_valid_uuid4(client_id)]
+    if len(valid_client_ids) != len(client_ids):
+        observability.db_logger.error(f"Skipping removal of invalid_ids={set(client_ids) - set(valid_client_ids)} (not valid UUID4)")
+    if not valid_client_ids:
+        return []
+    
+    response = await database.execute_query(database.supabase.table("Clients").delete().in_("client_id", valid_client_ids))
+    if response is None:
+        observability.db_logger.error(f"Failed to remove total_accounts={len(valid_client_ids)} accounts")
+        return []
+    
+    removed_client_ids = []
+    for row in response.data:
+        removed_client_ids.append(row["client_id"])
+        if _username_index is not None and row.get("name"):
+            _username_index.discard(row["name"])
+    await invalidate_sessions(removed_client_ids)
     
-    database._sync_supabase.table("Clients").delete().eq("client_id", client_id).execute()
-    observability.db_logger.warning(f"removed account client_id={client_id} on demand")
+    observability.db_logger.warning(f"removed total_accounts={len(removed_client_ids)} accounts client_ids={removed_client_ids}")
+    return removed_client_ids
     
     
\ No newline at end of file
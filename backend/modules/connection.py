@@ -1,15 +1,31 @@
 from datetime import datetime, timezone, timedelta
 from fastapi import WebSocket, WebSocketDisconnect
-from fastapi.websockets import WebSocketState
-from threading import Thread
 from enum import StrEnum
 import asyncio
 import time
+import os
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from modules.models import Client, CLIENT_SESSION_COLUMNS
+from modules.sessions import session_backend, SESSION_TTL, SESSION_TAKEOVER_TIMEOUT
 from modules import observability
 from modules import questions
 from modules import accounts
-from modules import database
+from modules import progress
+
+
+ORPHAN_CLEANER_INTERVAL = float(os.environ.get("ORPHAN_CLEANER_INTERVAL") or 30)  # Seconds.
+FORGOTTEN_CLEANER_INTERVAL = float(os.environ.get("FORGOTTEN_CLEANER_INTERVAL") or 60)  # Seconds.
+CLEANER_BATCH_SIZE = int(os.environ.get("CLEANER_BATCH_SIZE") or 500)  # Accounts per select/delete query.
+CLEANER_MAX_EXCLUDED_IDS = int(os.environ.get("CLEANER_MAX_EXCLUDED_IDS") or 200)  # Connected clients filtered out by the DB, above that - locally.
+CLEANER_MIN_ACCOUNT_AGE = timedelta(minutes=5)
+CLEANER_MIN_PRACTICE_INDEX = 5  # Accounts with at least that many answered questions are kept.
+
+WS_UNSUPPORTED_DATA = 1003  # Close code for frames the codec can not decode.
 
 
 class EventHeader(StrEnum):
@@ -19,6 +35,13 @@ class EventHeader(StrEnum):
     ANSWER_VALIDATION = "ANSWER_VALIDATION"
     SET_CLIENT_ID = "SET_CLIENT_ID"
     EXAM_FINISH = "EXAM_FINISH"
+    MEDIA_PREFETCH = "MEDIA_PREFETCH"
+    QUESTION_SHOWN = "QUESTION_SHOWN"
+
+
+# Events in the compact encodings, part of the protocol - new events have to be appended at the end of `EventHeader`.
+EVENT_IDS: dict[str, int] = {event: event_id for event_id, event in enumerate(EventHeader)}
+EVENTS_BY_ID: dict[int, EventHeader] = {event_id: event for event, event_id in EVENT_IDS.items()}
 
 
 def ws_response(event: EventHeader, data: dict | str | None) -> dict:
@@ -27,7 +50,122 @@ def ws_response(event: EventHeader, data: dict | str | None) -> dict:
         "content": data
     }
 
-open_handlers: dict[str, "WebSocketHandler"] = {} 
+
+class JsonCodec:
+    """ Default, `{"event": "...", "content": ..., "seq": ...}` text frames (`seq` only if the request had one). """
+    name = "json"
+    
+    def envelope(self, event: EventHeader, data: dict | list | str | None, seq: int | None = None) -> dict:
+        response = ws_response(event, data)
+        if seq is not None:
+            response["seq"] = seq
+        return response
+    
+    async def send(self, ws_client: WebSocket, event: EventHeader, data: dict | list | str | None, seq: int | None = None) -> None:
+        await ws_client.send_json(self.envelope(event, data, seq))
+        
+    async def receive(self, ws_client: WebSocket) -> dict:
+        return await ws_client.receive_json()
+
+
+class MsgpackCodec:
+    """ `[event_id, content, seq?]` MessagePack binary frames, selected with `?encoding=msgpack` or the `msgpack` subprotocol. """
+    name = "msgpack"
+    
+    def envelope(self, event: EventHeader, data: dict | list | str | None, seq: int | None = None) -> list:
+        return [EVENT_IDS[event], data] if seq is None else [EVENT_IDS[event], data, seq]
+    
+    async def send(self, ws_client: WebSocket, event: EventHeader, data: dict | list | str | None, seq: int | None = None) -> None:
+        await ws_client.send_bytes(msgpack.packb(self.envelope(event, data, seq)))
+        
+    async def receive(self, ws_client: WebSocket) -> dict:
+        try:
+            # Text frame - KeyError, malformed payload - msgpack's ValueError subclasses, not a `[event_id, content, seq?]` list - ValueError/TypeError.
+            event_id, content, *seq = msgpack.unpackb(await ws_client.receive_bytes())
+            event = EVENTS_BY_ID.get(event_id, event_id)
+        except (KeyError, ValueError, TypeError, msgpack.UnpackException) as error:
+            observability.api_logger.warning(f"Received undecodable msgpack WS frame from host={ws_client.client.host}: {error!r}. Closing connection...")
+            await ws_client.close(code=WS_UNSUPPORTED_DATA)
+            raise WebSocketDisconnect(WS_UNSUPPORTED_DATA)
+        
+        return {"event": event, "content": content, "seq": seq[0] if seq else None}
+
+
+def negotiate_codec(ws_client: WebSocket) -> tuple[JsonCodec | MsgpackCodec, str | None]:
+    """ Codec requested by the client and the subprotocol to accept the connection with. """
+    subprotocol = "msgpack" if "msgpack" in ws_client.scope.get("subprotocols", []) else None
+    encoding = subprotocol or ws_client.query_params.get("encoding") or "json"
+    
+    if encoding == "msgpack":
+        if msgpack is not None:
+            return (MsgpackCodec(), subprotocol)
+        observability.api_logger.warning("Client requested msgpack WS encoding, but msgpack is not installed. Falling back to JSON...")
+        
+    return (JsonCodec(), None)
+
+
+class HandlerRegistry:
+    """
+    Handlers of the open WS connections (one per client). Handlers are unregistered as soon as their
+    connection ends, only the disconnection time of the client is kept for the orphan cleaner.
+    Used only from the event loop, sessions of the other workers are tracked by the `session_backend`.
+    """
+    
+    def __init__(self) -> None:
+        self.__handlers: dict[str, "WebSocketHandler"] = {}
+        self.__disconnected_at: dict[str, float] = {}  # client_id: time.monotonic()
+        
+    def __contains__(self, client_id: str) -> bool:
+        return client_id in self.__handlers
+    
+    def __len__(self) -> int:
+        return len(self.__handlers)
+    
+    def get(self, client_id: str) -> "WebSocketHandler | None":
+        return self.__handlers.get(client_id)
+    
+    def connected_client_ids(self) -> list[str]:
+        return list(self.__handlers)
+    
+    async def register(self, handler: "WebSocketHandler") -> None:
+        """ Take the client over, returns once its previous handler (on this or another worker) is closed and its progress saved. """
+        await session_backend.claim(handler.client_id)
+        
+        previous_handler = self.__handlers.get(handler.client_id)
+        self.__handlers[handler.client_id] = handler
+        self.__disconnected_at.pop(handler.client_id, None)
+        observability.OPEN_CONNECTIONS.labels(mode=handler.mode).inc()
+        
+        if previous_handler is not None:  # Taken over, the previous one will not unregister itself.
+            observability.OPEN_CONNECTIONS.labels(mode=previous_handler.mode).dec()
+            await previous_handler.close()
+        
+    async def unregister(self, handler: "WebSocketHandler") -> None:
+        """ No-op if the client has already been taken over by another handler. """
+        if self.__handlers.get(handler.client_id) is not handler:
+            return
+        
+        del self.__handlers[handler.client_id]
+        await session_backend.release(handler.client_id)
+        self.__disconnected_at[handler.client_id] = time.monotonic()
+        observability.OPEN_CONNECTIONS.labels(mode=handler.mode).dec()
+        
+    def disconnected_client_ids(self) -> list[str]:
+        return list(self.__disconnected_at)
+    
+    def forget_disconnected(self, client_ids: list[str] | None = None, older_than: float | None = None) -> None:
+        """ Drop disconnection records of `client_ids` and/or the ones older than `older_than` seconds. """
+        for client_id in client_ids or ():
+            self.__disconnected_at.pop(client_id, None)
+        
+        if older_than is not None:
+            expired_before = time.monotonic() - older_than
+            for client_id, disconnected_at in list(self.__disconnected_at.items()):
+                if disconnected_at < expired_before:
+                    del self.__disconnected_at[client_id]
+    
+
+open_handlers = HandlerRegistry()
 
 
 class WebSocketHandler:
@@ -36,60 +174,115 @@ class WebSocketHandler:
         self.client_id = client_id
         self.mode = mode
         self.manager: questions.QuestionsManagerABC | None = None
+        self.client_data: Client | None = None
         self.__manager_base = manager_base
+        self.codec, self.__subprotocol = negotiate_codec(ws_client)
+        self.pipeline = ws_client.query_params.get("pipeline") == "true"  # ANSWER_VALIDATION carries the next question.
+        self.__closed = asyncio.Event()  # Set once the connection ended and the progress was flushed.
+        self.__task: asyncio.Task | None = None
+        self.__is_taken_over = False
+        self.__is_closing = False  # Flushing and releasing the session, must not be cancelled anymore.
 
     async def initialize(self):
-        await self.ws_client.accept()
-        
-        if self.client_id != "anon":
-            client_data = await accounts.get_client_by_id(self.client_id)
-            if client_data:
-                self.client_data = client_data
-            else:
-                observability.client_logger.warning(f"Client started WS/{self.mode} connection with client_id={self.client_id} but no user with this ID found.")
-                self.client_id = "anon"
-        
-        if self.client_id == "anon":
-            self.client_id = await accounts.create_anonymous_client()
-            
-            observability.client_logger.info(f"Created anonymous account for client_host={self.ws_client.client.host} with client_id={self.client_id}")
-            observability.api_logger.info(f"Associated client_host={self.ws_client.client.host} connection with generated client_id={self.client_id}. Informing client...")
-    
-            await self.ws_client.send_json(ws_response(EventHeader.SET_CLIENT_ID, self.client_id))
-            self.client_data = await accounts.get_client_by_id(self.client_id)
-    
-        self.manager = self.__manager_base(self.client_data)
-        await self.manager.initialize()
-    
-        if self.client_id in open_handlers:
-            await open_handlers[self.client_id].abort()
+        self.__task = asyncio.current_task()
+        await self.ws_client.accept(subprotocol=self.__subprotocol)
+        
+        try:
+            if self.client_id != "anon":
+                # Progress is read only after the previous session of this client (possibly on another worker) saved it.
+                await open_handlers.register(self)
+                await progress.flush_progress(self.client_id)
+                client_data = await accounts.get_client_by_id(self.client_id, CLIENT_SESSION_COLUMNS)
+                if client_data:
+                    self.client_data = client_data
+                else:
+                    observability.client_logger.warning(f"Client started WS/{self.mode} connection with client_id={self.client_id} but no user with this ID found.")
+                    await open_handlers.unregister(self)
+                    open_handlers.forget_disconnected([self.client_id])
+                    self.client_id = "anon"
             
-        open_handlers[self.client_id] = self
-    
-        await self.receive()
+            if self.client_id == "anon":
+                self.client_id = await accounts.create_anonymous_client()
+                
+                observability.client_logger.info(f"Created anonymous account for client_host={self.ws_client.client.host} with client_id={self.client_id}")
+                observability.api_logger.info(f"Associated client_host={self.ws_client.client.host} connection with generated client_id={self.client_id}. Informing client...")
+        
+                await self.send(EventHeader.SET_CLIENT_ID, self.client_id)
+                self.client_data = await accounts.get_client_by_id(self.client_id, CLIENT_SESSION_COLUMNS)
+                await open_handlers.register(self)
+        
+            self.manager = self.__manager_base(self.client_data)
+            await self.manager.initialize()
+        
+            await self.receive()
+        except asyncio.CancelledError:
+            if not self.__is_taken_over:
+                raise
+            self.__task.uncancel()
+        finally:
+            self.__is_closing = True
+            # Shielded - a cancellation (e.g. at shutdown) must not interrupt the flush nor leave the session claimed.
+            release = asyncio.ensure_future(self.__release())
+            release.add_done_callback(lambda _: self.__closed.set())
+            await asyncio.shield(release)
+
+    async def __release(self) -> None:
+        # Flushed before releasing the session, the next owner reads the progress once the session is released.
+        await progress.flush_progress(self.client_id)
+        await open_handlers.unregister(self)
 
     async def receive(self) -> None:
-        while True:
-            try:
-                message = await self.ws_client.receive_json()
-                observability.client_logger.debug(f"Received WS message from client_id={self.client_id} msg_content='{message}'")
+        try:
+            while True:
+                message = await self.codec.receive(self.ws_client)
+                observability.client_message_logger.debug("Received WS message from client_id=%s msg_content='%s'", self.client_id, message)
                 with observability.tracer.start_as_current_span(f"ws-{self.mode}-handle-message", attributes={"client_id": self.client_id, "event": message.get("event", "EVENTLESS?")}):
                     await self.handle_message(message)
-            except (RuntimeError, WebSocketDisconnect):
-                return
+        except (RuntimeError, WebSocketDisconnect):
+            return
+            
+    async def send(self, event: EventHeader, data: dict | list | str | None, seq: int | None = None) -> None:
+        await self.codec.send(self.ws_client, event, data, seq)
+        
+    async def send_upcoming_media(self) -> None:
+        upcoming_media = self.manager.upcoming_media()
+        if upcoming_media:
+            await self.send(EventHeader.MEDIA_PREFETCH, upcoming_media)
             
     async def handle_message(self, data: dict) -> None:
         event = data["event"]
         content = data["content"]
+        seq = data.get("seq")  # Echoed in the response, lets the client pipeline messages.
         
         match event:
             case EventHeader.GET_QUESTION:
                 event_header, question_data = await self.manager.provide_question()
-                return await self.ws_client.send_json(ws_response(event_header, question_data))
+                await self.send(event_header, question_data, seq)
+                
+                if event_header == EventHeader.QUESTION_DATA:
+                    await self.send_upcoming_media()
+                return
 
             case EventHeader.CHECK_ANSWER:
                 validation_response = await self.manager.handle_answer(content)
-                return await self.ws_client.send_json(ws_response(EventHeader.ANSWER_VALIDATION, validation_response))
+                if not self.pipeline:
+                    return await self.send(EventHeader.ANSWER_VALIDATION, validation_response, seq)
+                
+                # Next question in the same response, the client does not have to send GET_QUESTION.
+                # It may be shown after the feedback delay, answering is measured from its QUESTION_SHOWN.
+                event_header, question_data = await self.manager.provide_question(start_answering=False)
+                await self.send(EventHeader.ANSWER_VALIDATION, {
+                    "validation": validation_response,
+                    "next": self.codec.envelope(event_header, question_data)
+                }, seq)
+                
+                if event_header == EventHeader.QUESTION_DATA:
+                    await self.send_upcoming_media()
+                return
+            
+            case EventHeader.QUESTION_SHOWN:
+                self.manager.question_shown()
+                return
 
     async def abort(self) -> None:
         observability.api_logger.warning(f"Abort action was called on WS/{self.mode} connection with client_id={self.client_id} from host={self.ws_client.client.host} Most likely another Handler was created for this client...")
@@ -98,66 +291,106 @@ class WebSocketHandler:
         except:
             pass
             
+    async def close(self) -> None:
+        """ 
+        Abort the connection and wait (at most SESSION_TAKEOVER_TIMEOUT) until its progress is flushed.
+        The handler is cancelled (unless it is already closing), it does not wait for the closing handshake nor handle messages anymore.
+        """
+        await self.abort()
+        if self.__task is not None and not self.__is_closing:
+            self.__is_taken_over = True
+            self.__task.cancel()
+        try:
+            await asyncio.wait_for(self.__closed.wait(), SESSION_TAKEOVER_TIMEOUT)
+        except TimeoutError:
+            observability.api_logger.warning(f"WS/{self.mode} connection with client_id={self.client_id} did not close in time, its progress may be flushed later")
+            
+
+async def remove_orphan_connection_handlers() -> int:
+    """ 
+    Remove accounts of recently disconnected clients that have answered less than `CLEANER_MIN_PRACTICE_INDEX` questions.
+    Returns the amount of actually removed accounts.
+    """
+    disconnected_client_ids = open_handlers.disconnected_client_ids()
+    if not disconnected_client_ids:
+        return 0
+    
+    created_before = datetime.now(timezone.utc) - CLEANER_MIN_ACCOUNT_AGE
+    orphan_client_ids = await accounts.get_abandoned_client_ids(created_before, CLEANER_MIN_PRACTICE_INDEX, disconnected_client_ids[:CLEANER_BATCH_SIZE])
+    
+    # The client could have reconnected in the meantime (possibly to another worker).
+    connected_client_ids = await session_backend.connected_among(orphan_client_ids)
+    orphan_client_ids = [client_id for client_id in orphan_client_ids if client_id not in open_handlers and client_id not in connected_client_ids]
+    removed_client_ids = []
+    if orphan_client_ids:
+        observability.client_logger.warning(f"found orphan connections with less than {CLEANER_MIN_PRACTICE_INDEX} questions answered client_ids={orphan_client_ids} deleting accounts...")
+        removed_client_ids = await accounts.remove_accounts(orphan_client_ids)
+        open_handlers.forget_disconnected(removed_client_ids)
+    
+    # Accounts of the clients disconnected before that are old enough to have been checked already.
+    open_handlers.forget_disconnected(older_than=CLEANER_MIN_ACCOUNT_AGE.total_seconds())
+    return len(removed_client_ids)
 
-def orphan_connection_handlers_cleaner() -> None:
+async def remove_forgotten_anon_accounts() -> int:
+    created_before = datetime.now(timezone.utc) - CLEANER_MIN_ACCOUNT_AGE
+    
+    # Has an open WS connection, the account will be checked by the orphan cleaner after it disconnects.
+    connected_client_ids = open_handlers.connected_client_ids()
+    excluded_client_ids = connected_client_ids if len(connected_client_ids) <= CLEANER_MAX_EXCLUDED_IDS else None  # Keep the query URL bounded.
+    
+    forgotten_count = 0
+    last_client_id = None
     while True:
-        orphan_count = 0
-        now = datetime.now(timezone.utc)
+        page = await accounts.get_abandoned_client_ids(
+            created_before, CLEANER_MIN_PRACTICE_INDEX,
+            excluded_client_ids=excluded_client_ids, after_client_id=last_client_id, limit=CLEANER_BATCH_SIZE
+        )
+        if not page:
+            break
         
-        for client_id, handler in open_handlers.copy().items():
-            if handler.ws_client.client_state != WebSocketState.DISCONNECTED:
-                continue
-            
-            account = database._sync_supabase.table("Clients").select("*").eq("client_id", client_id).single().execute().model_dump()["data"]
-            if account is None:
-                return
-            
-            created_at = datetime.fromisoformat(account['created_at'])
-            if account['practice_index'] < 5 and (now - created_at > timedelta(minutes=5)):
-                observability.client_logger.warning(f"found orphan connection with only {account['practice_index']}<5 questions answered client_id={client_id} deleteing account...")
-                accounts.remove_account(client_id)
-                
-                del handler
-                del open_handlers[client_id]
-                
-                orphan_count += 1
+        connected_client_ids = await session_backend.connected_among(page)
+        forgotten_client_ids = [client_id for client_id in page if client_id not in open_handlers and client_id not in connected_client_ids]
+        if forgotten_client_ids:
+            observability.client_logger.warning(f"found forgotten accounts created before={created_before.isoformat()} client_ids={forgotten_client_ids}, removing...")
+            forgotten_count += len(await accounts.remove_accounts(forgotten_client_ids))
+        
+        if len(page) < CLEANER_BATCH_SIZE:
+            break
+        last_client_id = page[-1]
+    
+    return forgotten_count
+
+async def orphan_connection_handlers_cleaner() -> None:
+    while True:
+        await asyncio.sleep(ORPHAN_CLEANER_INTERVAL)
+        orphan_count = await remove_orphan_connection_handlers()
                 
         if orphan_count > 0:
             observability.client_logger.warning(f"Removed orphan_count={orphan_count} orphan connection handlers and their accounts")
         else:
             observability.client_logger.debug("No orphan connection handlers found.")
-            
-        time.sleep(30)
 
-def forgotten_anon_accounts_cleaner() -> None:
+async def forgotten_anon_accounts_cleaner() -> None:
     while True:
-        forgotten_count = 0
-        now = datetime.now(timezone.utc)
-        
-        for anon_client in accounts.get_all_anon_and_test_clients():
-            client_id = anon_client['client_id']
-
-            if client_id in open_handlers or client_id is None:  
-                # Has (possibly) open WS connection. If connection is orphaned, orphan cleaner will close it
-                # and the forgotten account will be removed in the next check.
-                continue
-
-            created_at = datetime.fromisoformat(anon_client['created_at'])
-            if now - created_at < timedelta(minutes=5):
-                continue
-            
-            if anon_client['practice_index'] < 5:
-                observability.client_logger.warning(f"found forgotten account client_id={client_id} created_at={anon_client['created_at']} >5minutes, removing...")
-                accounts.remove_account(client_id)
-                forgotten_count += 1 
+        await asyncio.sleep(FORGOTTEN_CLEANER_INTERVAL)
+        if not await session_backend.is_leader("forgotten-accounts-cleaner"):
+            continue
+        forgotten_count = await remove_forgotten_anon_accounts()
 
         if forgotten_count > 0:
             observability.client_logger.warning(f"Removed forgotten_count={forgotten_count} forgotten accounts")
         else:
             observability.client_logger.debug("No forgotten accounts found.")
 
-        time.sleep(60)
+async def abort_taken_over_handler(client_id: str) -> None:
+    """ The client was taken over by another worker, which waits until its progress is saved here. """
+    handler = open_handlers.get(client_id)
+    if handler is not None:
+        await handler.close()
+    await progress.flush_progress(client_id)  # E.g. left pending by a failed flush.
 
-
-Thread(target=orphan_connection_handlers_cleaner, daemon=True).start()
-Thread(target=forgotten_anon_accounts_cleaner, daemon=True).start()
+async def session_refresh_loop() -> None:
+    """ Keep the sessions of this worker alive in the `session_backend`. """
+    while True:
+        await asyncio.sleep(SESSION_TTL / 3)
+        await session_backend.refresh(open_handlers.connected_client_ids())
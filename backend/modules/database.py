@@ -1,15 +1,36 @@
-from supabase import acreate_client, AsyncClient, create_client, Client
+from supabase import acreate_client, AsyncClient
 import postgrest
 import asyncio
+import random
+import time
 import os
 
 from modules import observability
-
+from modules.models import Question, QUESTION_COLUMNS
+
+
+QUESTION_BANK_TTL = float(os.environ.get("QUESTION_BANK_TTL") or 0)  # Seconds, 0 - never expires.
+QUESTION_BANK_PAGE_SIZE = 1000
+EXAM_LINE_SEED = os.environ.get("EXAM_LINE_SEED")  # Fixed seed makes every exam line reproducible (load tests).
+EXAM_LINE_SOURCE = os.environ.get("EXAM_LINE_SOURCE") or "local"  # local/database
+EXAM_BUCKET_TIMEOUT = float(os.environ.get("EXAM_BUCKET_TIMEOUT") or 3)  # Seconds, per `exam_*` query.
+EXAM_BUCKET_FAILURE_POLICY = os.environ.get("EXAM_BUCKET_FAILURE_POLICY") or "fill"  # fill (from question bank)/fail
+PROGRESS_UPDATE_CONCURRENCY = int(os.environ.get("PROGRESS_UPDATE_CONCURRENCY") or 16)  # Concurrent progress UPDATE queries.
+
+# (set, points): amount of questions in the exam line. Order of the keys is the order in the line.
+EXAM_LINE_QUOTAS: dict[tuple[str, int], int] = {
+    ("PODSTAWOWY", 3): 10,
+    ("PODSTAWOWY", 2): 6,
+    ("PODSTAWOWY", 1): 4,
+    
+    ("SPECJALISTYCZNY", 3): 6,
+    ("SPECJALISTYCZNY", 2): 4,
+    ("SPECJALISTYCZNY", 1): 2,
+}
 
 url: str = os.environ.get("SUPABASE_URL")
 key: str = os.environ.get("SUPABASE_KEY")
 supabase: AsyncClient | None = None
-_sync_supabase: Client = create_client(url, key)
 
 async def get_supabase():  
     global supabase
@@ -29,63 +50,163 @@ async def execute_query(query: postgrest.AsyncRequestBuilder) -> postgrest.APIRe
         observability.db_logger.error(f"Unkown db query error: {error}")
 
 
-def __parse_answers(question_data: dict) -> dict:
-    """ Turn answer_a, answer_b, ... to: "answers": "TN"/{"A": "...", "B": "..."} """
-    if not question_data["answer_a"]: # Tak/Nie
-        question_data["answers"] = "TN"
-    else: # ABC
-        question_data["answers"] = {
-            "A": question_data["answer_a"],
-            "B": question_data["answer_b"],
-            "C": question_data["answer_c"],
-        }
+_question_bank: dict[int, Question] = {}
+_exam_buckets: dict[tuple[str, int], list[int]] = {}
+_question_bank_loaded_at: float = 0
+_question_bank_refresh: asyncio.Task | None = None
+
+async def load_question_bank() -> bool:
+    """ (Re)load the whole `Questions` table into memory. Keeps the previous bank on failure. """
+    global _question_bank, _exam_buckets, _question_bank_loaded_at
+    
+    question_bank = {}
+    page_start = 0
+    while True:
+        query = supabase.table("Questions").select(QUESTION_COLUMNS).order("index").range(page_start, page_start + QUESTION_BANK_PAGE_SIZE - 1)
+        response = await execute_query(query)
+        if response is None:
+            observability.db_logger.error(f"Failed to load question bank page_start={page_start} (keeping previous bank with total_questions={len(_question_bank)})")
+            return False
         
-    del question_data["answer_a"]
-    del question_data["answer_b"]
-    del question_data["answer_c"]
+        rows = response.data
+        for row in rows:
+            question_bank[row["index"]] = Question.from_row(row)
+
+        if len(rows) < QUESTION_BANK_PAGE_SIZE:
+            break
+        page_start += QUESTION_BANK_PAGE_SIZE
+    
+    exam_buckets = {bucket: [] for bucket in EXAM_LINE_QUOTAS}
+    for index, question in question_bank.items():
+        bucket = (question.category, question.points)
+        if bucket in exam_buckets:
+            exam_buckets[bucket].append(index)
+    
+    _question_bank = question_bank
+    _exam_buckets = exam_buckets
+    _question_bank_loaded_at = time.time()
+    observability.db_logger.info(f"Loaded question bank with total_questions={len(question_bank)}")
+    return True
+
+async def refresh_question_bank() -> bool:
+    return await load_question_bank()
+
+def __schedule_question_bank_refresh() -> None:
+    """ Refresh expired bank in the background, stale questions are served in the meantime. """
+    global _question_bank_refresh
+    
+    if not QUESTION_BANK_TTL or time.time() - _question_bank_loaded_at < QUESTION_BANK_TTL:
+        return
+    if _question_bank_refresh is not None and not _question_bank_refresh.done():
+        return
+    
+    _question_bank_refresh = asyncio.create_task(refresh_question_bank())
 
-    return question_data
+def get_cached_question(index: int) -> Question | None:
+    """ Question from the bank without falling back to the database. """
+    return _question_bank.get(index)
 
+async def fetch_question(index: int) -> Question:
+    __schedule_question_bank_refresh()
+    
+    question = _question_bank.get(index)
+    if question is not None:
+        observability.QUESTION_BANK_HITS.inc()
+        return question
 
-async def fetch_question(index: int) -> dict:
-    query = supabase.table("Questions").select("*").eq("index", index)
+    observability.QUESTION_BANK_MISSES.inc()
+    query = supabase.table("Questions").select(QUESTION_COLUMNS).eq("index", index)
     response = await execute_query(query)
-    question_row = response.model_dump()["data"][0]
-    return __parse_answers(question_row)
+    question = Question.from_row(response.data[0])
+    _question_bank[index] = question
+    return question
 
+asyncio.get_event_loop().run_until_complete(load_question_bank())
 
-async def set_practice_index(client_id: str, index: int) -> None:
-    await execute_query(
-        supabase.table("Clients").update({"practice_index": index}).eq("client_id", client_id)
-    )
 
-async def mark_as_hard_question(client_data: dict, question_index: int) -> list[int]:
-    current_hard = client_data["practice_hard_questions"]
-    client_id = client_data["client_id"]
-    if question_index in current_hard:
-        return current_hard
+async def update_clients_progress(rows: dict[str, dict]) -> list[str]:
+    """
+    UPDATE of every `client_id: row` (at most PROGRESS_UPDATE_CONCURRENCY at once), returns IDs of the failed ones.
+    Never inserts - rows of accounts removed in the meantime (e.g. by the cleaners) are not re-created.
+    """
+    semaphore = asyncio.Semaphore(PROGRESS_UPDATE_CONCURRENCY)
     
-    new_hard_list = current_hard + [question_index]
-    await execute_query(
-        supabase.table("Clients").update({"practice_hard_questions": new_hard_list}).eq("client_id", client_id)
-    )
+    async def update(client_id: str, row: dict) -> bool:
+        async with semaphore:
+            response = await execute_query(supabase.table("Clients").update(row).eq("client_id", client_id))
+            return response is not None
     
-    return new_hard_list
+    results = await asyncio.gather(*(update(client_id, row) for client_id, row in rows.items()))
+    return [client_id for client_id, is_updated in zip(rows, results) if not is_updated]
+
+def get_exam_media_names() -> list[str]:
+    """ Media of all exam-eligible questions in the question bank. """
+    return [
+        _question_bank[index].media_name
+        for bucket in EXAM_LINE_QUOTAS
+        for index in _exam_buckets.get(bucket, ())
+        if _question_bank[index].media_name
+    ]
+
+def __can_generate_local_exam_line() -> bool:
+    return all(len(_exam_buckets.get(bucket, ())) >= quota for bucket, quota in EXAM_LINE_QUOTAS.items())
+
+def __sample_exam_bucket(rng: random.Random, bucket: tuple[str, int], quota: int) -> list[Question]:
+    return [_question_bank[index] for index in rng.sample(_exam_buckets[bucket], quota)]
+
+def __generate_local_exam_line(seed: int | str | None) -> list[Question]:
+    rng = random.Random(seed)
+    questions_line = []
     
-async def unmark_as_hard_question(client_data: dict, question_index: int) -> list[int]:
-    current_hard = client_data["practice_hard_questions"]
-    client_id = client_data["client_id"]
-    if question_index not in current_hard:
-        return current_hard
+    for bucket, quota in EXAM_LINE_QUOTAS.items():
+        questions_line.extend(__sample_exam_bucket(rng, bucket, quota))
     
-    current_hard.remove(question_index)
-    await execute_query(
-        supabase.table("Clients").update({"practice_hard_questions": current_hard}).eq("client_id", client_id)
-    )
+    return questions_line
+
+async def __fetch_exam_bucket(bucket: tuple[str, int], quota: int) -> list[Question] | None:
+    category, points = bucket
+    bucket_name = f"exam_{category.lower()}_{points}p"
+    query = supabase.table(bucket_name).select(QUESTION_COLUMNS).limit(quota)
+
+    with observability.EXAM_BUCKET_FETCH_TIME.labels(bucket=bucket_name).time():
+        try:
+            response = await asyncio.wait_for(execute_query(query), EXAM_BUCKET_TIMEOUT)
+        except asyncio.TimeoutError:
+            observability.db_logger.error(f"Exam bucket={bucket_name} query timed out after timeout={EXAM_BUCKET_TIMEOUT}s")
+            return
+    
+    if response is None:
+        return
+    
+    rows = response.data
+    if len(rows) < quota:
+        observability.db_logger.error(f"Exam bucket={bucket_name} returned only {len(rows)}<{quota} questions")
+        return
+    
+    return [Question.from_row(row) for row in rows]
+
+async def __fetch_exam_line_from_db(seed: int | str | None) -> list[Question]:
+    """ Query all buckets concurrently, failed buckets are handled according to `EXAM_BUCKET_FAILURE_POLICY`. """
+    buckets_rows = await asyncio.gather(*(
+        __fetch_exam_bucket(bucket, quota) for bucket, quota in EXAM_LINE_QUOTAS.items()
+    ))
     
-    return current_hard
+    rng = random.Random(seed)
+    questions_line = []
+    
+    for (bucket, quota), rows in zip(EXAM_LINE_QUOTAS.items(), buckets_rows):
+        if rows is None:
+            if EXAM_BUCKET_FAILURE_POLICY != "fill" or len(_exam_buckets.get(bucket, ())) < quota:
+                raise RuntimeError(f"failed to fetch exam bucket={bucket} (policy={EXAM_BUCKET_FAILURE_POLICY})")
+            
+            observability.db_logger.warning(f"Filling failed exam bucket={bucket} from the question bank")
+            rows = __sample_exam_bucket(rng, bucket, quota)
+            
+        questions_line.extend(rows)
+    
+    return questions_line
 
-async def generate_exam_line() -> list[dict]:
+async def generate_exam_line(seed: int | str | None = None) -> list[Question]:
     """  
     20 questions from "PODSTAWOWY" set:
         - 10x 3p.
@@ -96,26 +217,18 @@ async def generate_exam_line() -> list[dict]:
         - 6x 3p.
         - 4x 2p.
         - 2x 1p.
+        
+    Sampled from the question bank, the `exam_*` views are used with EXAM_LINE_SOURCE=database 
+    or when the bank cannot fill the quotas.
     """
+    if seed is None:
+        seed = EXAM_LINE_SEED
     
-    queries = [
-        supabase.table("exam_podstawowy_3p").select("*").limit(10),
-        supabase.table("exam_podstawowy_2p").select("*").limit(6),
-        supabase.table("exam_podstawowy_1p").select("*").limit(4),
-        
-        supabase.table("exam_specjalistyczny_3p").select("*").limit(6),
-        supabase.table("exam_specjalistyczny_2p").select("*").limit(4),
-        supabase.table("exam_specjalistyczny_1p").select("*").limit(2),
-    ]
+    if EXAM_LINE_SOURCE == "database":
+        return await __fetch_exam_line_from_db(seed)
     
-    questions_line = []
-
-    for query in queries:
-        query = await execute_query(query)
-        results = query.model_dump()["data"]
-        for result in results:
-            questions_line.append(__parse_answers(result))        
-        
+    if __can_generate_local_exam_line():
+        return __generate_local_exam_line(seed)
     
-    return questions_line
-
+    observability.db_logger.warning(f"Question bank cannot fill exam quotas (total_questions={len(_question_bank)}), fetching exam line from the database...")
+    return await __fetch_exam_line_from_db(seed)
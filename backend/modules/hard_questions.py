@@ -0,0 +1,58 @@
+from collections.abc import Iterable, Iterator
+import random
+
+
+class HardQuestions:
+    """
+    Hard questions of a single practice session.
+
+    Membership, marking and unmarking are O(1). Every question keeps its miss count
+    and the turn it was last shown, which are used to weight `sample()` - frequently
+    missed questions are replayed more often, but the recently shown ones are pushed back.
+    Only the indexes are persisted (as a sorted int array).
+    """
+
+    def __init__(self, question_indexes: Iterable[int] = ()) -> None:
+        self._misses: dict[int, int] = {index: 1 for index in question_indexes}
+        self._last_seen: dict[int, int] = dict.fromkeys(self._misses, 0)
+        self._turn = 0
+
+    def __len__(self) -> int:
+        return len(self._misses)
+
+    def __contains__(self, question_index: int) -> bool:
+        return question_index in self._misses
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._misses)
+
+    def add(self, question_index: int) -> bool:
+        """ Count a miss. Returns True if the question has just become hard. """
+        is_new = question_index not in self._misses
+        self._misses[question_index] = self._misses.get(question_index, 0) + 1
+        self._last_seen[question_index] = self._turn
+        return is_new
+
+    def remove(self, question_index: int) -> bool:
+        """ Returns True if the question was hard. """
+        if self._misses.pop(question_index, None) is None:
+            return False
+
+        del self._last_seen[question_index]
+        return True
+
+    def advance(self) -> None:
+        """ Move to the next turn (call once per provided question). """
+        self._turn += 1
+
+    def sample(self, rng: random.Random | None = None) -> int:
+        """ Pick a hard question weighted by: miss count * turns since it was last shown. """
+        indexes = list(self._misses)
+        weights = [self._misses[index] * (self._turn - self._last_seen[index] + 1) for index in indexes]
+
+        question_index = (rng or random).choices(indexes, weights)[0]
+        self._last_seen[question_index] = self._turn
+        return question_index
+
+    def to_sorted_list(self) -> list[int]:
+        return sorted(self._misses)
@@ -0,0 +1,141 @@
+from prometheus_client import Counter, Gauge
+import urllib.request
+import threading
+import logging
+import atexit
+import queue
+import gzip
+import json
+import time
+import os
+
+
+LOKI_QUEUE_SIZE = int(os.getenv("LOKI_QUEUE_SIZE") or 10_000)  # Records, newest records are dropped when full.
+LOKI_BATCH_SIZE = int(os.getenv("LOKI_BATCH_SIZE") or 500)  # Records per push request.
+LOKI_BATCH_BYTES = int(os.getenv("LOKI_BATCH_BYTES") or 1024 * 1024)  # Uncompressed log lines per push request.
+LOKI_FLUSH_INTERVAL = float(os.getenv("LOKI_FLUSH_INTERVAL") or 1)  # Seconds, max delay of a record.
+LOKI_PUSH_TIMEOUT = float(os.getenv("LOKI_PUSH_TIMEOUT") or 5)  # Seconds.
+
+LOKI_RECORDS_SHIPPED = Counter(
+    "loki_records_shipped",
+    "Log records pushed to Loki."
+)
+
+LOKI_RECORDS_DROPPED = Counter(
+    "loki_records_dropped",
+    "Log records dropped (queue full or failed push).",
+    ["reason"]
+)
+
+LOKI_RECORDS_QUEUED = Gauge(
+    "loki_records_queued",
+    "Log records waiting to be pushed to Loki.",
+    multiprocess_mode="livesum"  # Sum of the running workers, queues of the dead ones are gone.
+)
+
+_Labels = tuple[tuple[str, str], ...]
+
+
+class LokiShipper:
+    """
+    Single background thread pushing the records of every logger to Loki, in gzipped batches of up to
+    `batch_size` records / `batch_bytes`, at least every `flush_interval` seconds.
+    The queue is bounded - logging never blocks, records are dropped (and counted) instead.
+    """
+
+    def __init__(self, url: str, queue_size: int = LOKI_QUEUE_SIZE, batch_size: int = LOKI_BATCH_SIZE,
+                 batch_bytes: int = LOKI_BATCH_BYTES, flush_interval: float = LOKI_FLUSH_INTERVAL) -> None:
+        self.url = url
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.flush_interval = flush_interval
+        self.__queue: queue.Queue[tuple[_Labels, str, str] | None] = queue.Queue(queue_size)
+        self.__thread = threading.Thread(target=self.__run, name="loki-shipper", daemon=True)
+        self.__thread.start()
+        atexit.register(self.close)
+
+    def submit(self, labels: _Labels, timestamp_ns: int, line: str) -> None:
+        try:
+            self.__queue.put_nowait((labels, str(timestamp_ns), line))
+        except queue.Full:
+            LOKI_RECORDS_DROPPED.labels(reason="queue_full").inc()
+            return
+        LOKI_RECORDS_QUEUED.inc()
+
+    def close(self, timeout: float = LOKI_PUSH_TIMEOUT) -> None:
+        """ Push the queued records and stop the thread. """
+        if not self.__thread.is_alive():
+            return
+
+        try:
+            self.__queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self.__thread.join(timeout)
+
+    def __next_batch(self) -> tuple[list[tuple[_Labels, str, str]], bool]:
+        """ Records until the batch is full or `flush_interval` passes, and whether the shipper was closed. """
+        batch = []
+        batch_bytes = 0
+        deadline = time.monotonic() + self.flush_interval
+
+        while len(batch) < self.batch_size and batch_bytes < self.batch_bytes:
+            try:
+                record = self.__queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+
+            if record is None:
+                return (batch, True)
+            batch.append(record)
+            batch_bytes += len(record[2])
+
+        return (batch, False)
+
+    def __run(self) -> None:
+        while True:
+            batch, is_closed = self.__next_batch()
+            if batch:
+                LOKI_RECORDS_QUEUED.dec(len(batch))
+                self.__push(batch)
+            if is_closed:
+                return
+
+    def __push(self, batch: list[tuple[_Labels, str, str]]) -> None:
+        streams: dict[_Labels, list[list[str]]] = {}
+        for labels, timestamp_ns, line in batch:
+            streams.setdefault(labels, []).append([timestamp_ns, line])
+
+        payload = {"streams": [{"stream": dict(labels), "values": values} for labels, values in streams.items()]}
+        request = urllib.request.Request(
+            self.url,
+            data=gzip.compress(json.dumps(payload).encode()),
+            headers={"Content-Type": "application/json", "Content-Encoding": "gzip"},
+            method="POST"
+        )
+
+        try:
+            with urllib.request.urlopen(request, timeout=LOKI_PUSH_TIMEOUT):
+                pass
+        except Exception:  # Logging the failure would feed the queue.
+            LOKI_RECORDS_DROPPED.labels(reason="push_failed").inc(len(batch))
+            return
+        LOKI_RECORDS_SHIPPED.inc(len(batch))
+
+
+class LokiHandler(logging.Handler):
+    """ Formats the record in the logging thread and hands it over to the shared `LokiShipper`. """
+
+    def __init__(self, shipper: LokiShipper, tags: dict[str, str]) -> None:
+        super().__init__()
+        self.shipper = shipper
+        self.tags = tuple(tags.items())
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            line = self.format(record)
+        except Exception:
+            return self.handleError(record)
+
+        labels = self.tags + (("logger", record.name), ("severity", record.levelname.lower()))
+        self.shipper.submit(labels, int(record.created * 1e9), line)
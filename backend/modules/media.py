@@ -0,0 +1,246 @@
+from fastapi.responses import FileResponse, StreamingResponse
+from fastapi import Request, Response
+from email.utils import formatdate
+from collections import OrderedDict
+from typing import NamedTuple
+import mimetypes
+import threading
+import asyncio
+import os
+
+from modules import observability
+
+
+MEDIA_DIRECTORY = os.path.realpath("../media/")
+MEDIA_CHUNK_SIZE = 256 * 1024
+MEDIA_CACHE_CONTROL = os.environ.get("MEDIA_CACHE_CONTROL") or "public, max-age=86400"
+MEDIA_CACHE_MAX_BYTES = int(os.environ.get("MEDIA_CACHE_MAX_BYTES") or 0)  # 0 - cache disabled.
+MEDIA_CACHE_MAX_FILE_BYTES = int(os.environ.get("MEDIA_CACHE_MAX_FILE_BYTES") or 16 * 1024 * 1024)
+MEDIA_CACHE_PREWARM = os.environ.get("MEDIA_CACHE_PREWARM") == "true"
+
+
+class CachedMedia(NamedTuple):
+    data: bytes
+    media_type: str
+    stat_result: os.stat_result
+
+
+class MediaCache:
+    """ LRU of whole, immutable media files bounded by their total size in bytes. """
+    
+    def __init__(self, max_bytes: int, max_file_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.max_file_bytes = min(max_file_bytes, max_bytes)
+        self.total_bytes = 0
+        self.__entries: OrderedDict[str, CachedMedia] = OrderedDict()
+        self.__lock = threading.Lock()  # Pre-warming runs in a worker thread.
+        
+    def get(self, media_name: str) -> CachedMedia | None:
+        with self.__lock:
+            entry = self.__entries.get(media_name)
+            if entry is not None:
+                self.__entries.move_to_end(media_name)
+        
+        if entry is None:
+            observability.MEDIA_CACHE_MISSES.inc()
+        else:
+            observability.MEDIA_CACHE_HITS.inc()
+        return entry
+        
+    def load(self, media_name: str, path: str, stat_result: os.stat_result) -> CachedMedia | None:
+        """ Read the file into the cache, evicting the least recently used files. None if it does not fit. """
+        if stat_result.st_size > self.max_file_bytes:
+            return
+        
+        with open(path, "rb") as file:
+            entry = CachedMedia(file.read(), get_media_type(path), stat_result)
+        
+        with self.__lock:
+            previous_entry = self.__entries.pop(media_name, None)
+            if previous_entry is not None:
+                self.total_bytes -= len(previous_entry.data)
+            
+            while self.__entries and self.total_bytes + len(entry.data) > self.max_bytes:
+                _, evicted_entry = self.__entries.popitem(last=False)
+                self.total_bytes -= len(evicted_entry.data)
+                observability.MEDIA_CACHE_EVICTIONS.inc()
+                
+            self.__entries[media_name] = entry
+            self.total_bytes += len(entry.data)
+        
+        return entry
+    
+    def prewarm(self, media_names: list[str]) -> int:
+        """ Load files until the cache is full, returns amount of loaded files. """
+        loaded = 0
+        for media_name in media_names:
+            path = get_media_path(media_name)
+            if path is None:
+                continue
+            
+            stat_result = os.stat(path)
+            if self.total_bytes + stat_result.st_size > self.max_bytes:
+                continue
+            if self.load(media_name, path, stat_result) is not None:
+                loaded += 1
+        
+        observability.api_logger.info(f"Pre-warmed media cache with loaded={loaded} files total_bytes={self.total_bytes}")
+        return loaded
+
+
+media_cache = MediaCache(MEDIA_CACHE_MAX_BYTES, MEDIA_CACHE_MAX_FILE_BYTES) if MEDIA_CACHE_MAX_BYTES else None
+
+
+def get_media_path(media_name: str) -> str | None:
+    """ Path of the media file inside of the MEDIA_DIRECTORY (None if the name escapes it or file does not exist). """
+    path = os.path.realpath(os.path.join(MEDIA_DIRECTORY, media_name))
+    if os.path.dirname(path) != MEDIA_DIRECTORY or not os.path.isfile(path):
+        return
+    return path
+
+def get_media_size(media_name: str) -> int | None:
+    path = get_media_path(media_name)
+    if path is not None:
+        return os.path.getsize(path)
+
+def get_media_type(path: str) -> str:
+    return mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+def __etag(stat_result: os.stat_result) -> str:
+    return f'"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"'
+
+def __is_not_modified(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+def parse_range(range_header: str, file_size: int) -> tuple[int, int] | None:
+    """
+    Parse a single `bytes=start-end` range into inclusive (start, end) offsets.
+    None for malformed or unsupported (other units, multiple ranges) headers, which are ignored (RFC 9110 14.2).
+    Raises ValueError for valid ranges that are unsatisfiable.
+    """
+    unit, _, byte_range = range_header.partition("=")
+    if unit.strip() != "bytes" or "," in byte_range:
+        return
+
+    start, separator, end = (part.strip() for part in byte_range.partition("-"))
+    if not separator or not (start or end) or not all(part.isdecimal() for part in (start, end) if part):
+        return
+
+    if not start:  # Suffix: last N bytes.
+        suffix_length = int(end)
+        if suffix_length == 0:
+            raise ValueError(f"unsatisfiable range: {range_header}")
+        return (max(file_size - suffix_length, 0), file_size - 1)
+
+    start = int(start)
+    if end and int(end) < start:
+        return
+    if start >= file_size:
+        raise ValueError(f"unsatisfiable range: {range_header}")
+
+    return (start, min(int(end), file_size - 1) if end else file_size - 1)
+
+def __iter_file_range(path: str, start: int, end: int):
+    with open(path, "rb") as file:
+        file.seek(start)
+        remaining = end - start + 1
+
+        while remaining > 0:
+            chunk = file.read(min(MEDIA_CHUNK_SIZE, remaining))
+            if not chunk:
+                return
+            remaining -= len(chunk)
+            yield chunk
+
+def __base_headers(stat_result: os.stat_result) -> dict[str, str]:
+    return {
+        "etag": __etag(stat_result),
+        "last-modified": formatdate(stat_result.st_mtime, usegmt=True),
+        "cache-control": MEDIA_CACHE_CONTROL,
+        "accept-ranges": "bytes",
+    }
+
+def __requested_range(request: Request, etag: str) -> str | None:
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    
+    if range_header and (not if_range or if_range == etag):
+        return range_header
+
+def __file_response(path: str, stat_result: os.stat_result, request: Request) -> Response:
+    file_size = stat_result.st_size
+    headers = __base_headers(stat_result)
+
+    if __is_not_modified(request, headers["etag"]):
+        return Response(status_code=304, headers=headers)
+
+    media_type = get_media_type(path)
+    range_header = __requested_range(request, headers["etag"])
+
+    try:
+        byte_range = parse_range(range_header, file_size) if range_header else None
+    except ValueError:
+        return Response(status_code=416, headers=headers | {"content-range": f"bytes */{file_size}"})
+
+    if byte_range is not None:
+        start, end = byte_range
+        headers["content-range"] = f"bytes {start}-{end}/{file_size}"
+        headers["content-length"] = str(end - start + 1)
+        return StreamingResponse(__iter_file_range(path, start, end), status_code=206, media_type=media_type, headers=headers)
+
+    if range_header:  # Ignored, but `FileResponse` would parse it again (400 or a multipart response).
+        headers["content-length"] = str(file_size)
+        return StreamingResponse(__iter_file_range(path, 0, file_size - 1), media_type=media_type, headers=headers)
+
+    # Chunked reads, or zero-copy `pathsend` on ASGI servers supporting it.
+    return FileResponse(path, media_type=media_type, headers=headers, stat_result=stat_result)
+
+def __cached_response(entry: CachedMedia, request: Request) -> Response:
+    file_size = len(entry.data)
+    headers = __base_headers(entry.stat_result)
+
+    if __is_not_modified(request, headers["etag"]):
+        return Response(status_code=304, headers=headers)
+    
+    range_header = __requested_range(request, headers["etag"])
+    try:
+        byte_range = parse_range(range_header, file_size) if range_header else None
+    except ValueError:
+        return Response(status_code=416, headers=headers | {"content-range": f"bytes */{file_size}"})
+
+    if byte_range is not None:
+        start, end = byte_range
+        headers["content-range"] = f"bytes {start}-{end}/{file_size}"
+        observability.MEDIA_CACHE_BYTES_SERVED.inc(end - start + 1)
+        return Response(memoryview(entry.data)[start:end + 1], status_code=206, media_type=entry.media_type, headers=headers)
+    
+    observability.MEDIA_CACHE_BYTES_SERVED.inc(file_size)
+    return Response(entry.data, media_type=entry.media_type, headers=headers)
+
+async def media_response(media_name: str, request: Request) -> Response | None:
+    """ Serve the media (from the cache if enabled), honours `Range`, `If-Range` and `If-None-Match`. None if not found. """
+    if media_cache is not None:
+        entry = media_cache.get(media_name)
+        if entry is not None:
+            return __cached_response(entry, request)
+    
+    path = get_media_path(media_name)
+    if path is None:
+        return
+    
+    stat_result = os.stat(path)
+    if media_cache is not None:
+        entry = await asyncio.to_thread(media_cache.load, media_name, path, stat_result)
+        if entry is not None:
+            return __cached_response(entry, request)
+    
+    return __file_response(path, stat_result, request)
+
+def prewarm_media_cache(media_names: list[str]) -> None:
+    if media_cache is not None and MEDIA_CACHE_PREWARM:
+        media_cache.prewarm(media_names)
@@ -1,54 +1,109 @@
 from prometheus_client import REGISTRY, Gauge
+import threading
+import asyncio
 import json
 import os
 
+from modules.sessions import session_backend
+from modules import observability
 
-EXPORT_FILE_PATH = "../lgtm/export.json"
-if not os.path.exists(EXPORT_FILE_PATH):
-    open(EXPORT_FILE_PATH, "a+").close()
+
+EXPORT_FILE_PATH = "../lgtm/export.jsonl"  # One `[name, labels, value]` sample per line.
+LEGACY_EXPORT_FILE_PATH = "../lgtm/export.json"
+SNAPSHOT_INTERVAL = float(os.getenv("METRICS_SNAPSHOT_INTERVAL") or 15)  # Seconds.
+
+_last_snapshot: list[tuple[str, dict, float]] | None = None
+# Exports run in worker threads, a cancelled `snapshot_loop` does not stop the one in progress.
+_export_lock = threading.Lock()
+
+
+def __is_persisted(collector) -> bool:
+    return collector in observability.PERSISTED_GAUGES
+
+def __collect_gauges() -> list[tuple[str, dict, float]]:
+    """ 
+    Only the `observability.PERSISTED_GAUGES` are persisted, other gauges describe the current state of the process.
+    In the multi-worker mode samples of all the workers are summed up.
+    """
+    persisted_collectors = [collector for collector in dict.fromkeys(REGISTRY._names_to_collectors.values()) if __is_persisted(collector)]
     
+    if observability.PROMETHEUS_MULTIPROC_DIR:
+        persisted_names = {collector._name for collector in persisted_collectors}
+        metrics = [metric for metric in observability.metrics_registry().collect() if metric.name in persisted_names]
+    else:
+        metrics = [metric for collector in persisted_collectors for metric in collector.collect()]
     
-def export_metrics() -> None:
-    export_data = {}
+    snapshot = []
+    for metric in metrics:
+        for sample in metric.samples:
+            snapshot.append((metric.name, sample.labels, sample.value))
     
-    for metric in REGISTRY.collect():
-        mname = metric.name
-        mtype = metric.type
-        samples = metric.samples
+    snapshot.sort(key=lambda sample: (sample[0], sorted(sample[1].items())))  # Stable order for the change detection.
+    return snapshot
+    
+def export_metrics() -> bool:
+    """ Atomically (temp file + rename) write the gauges, only if they changed since the last export. """
+    global _last_snapshot
+    
+    with _export_lock:
+        snapshot = __collect_gauges()
+        if snapshot == _last_snapshot:
+            return False
         
-        if mtype == 'info':
-            mtype = 'gauge'
-        elif mtype == 'stateset':
-            mtype = 'gauge'
-
-        if mtype != 'gauge' or not samples:
-            continue
-
-        export_data[mname] = []
-        for sample in samples:
-            export_data[mname].append(
-                [sample.labels, sample.value]
-            )
+        temp_path = f"{EXPORT_FILE_PATH}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as file:
+            for sample in snapshot:
+                file.write(json.dumps(sample, separators=(",", ":")) + "\n")
+        os.replace(temp_path, EXPORT_FILE_PATH)
         
-    with open(EXPORT_FILE_PATH, "w+") as file:
-        json.dump(export_data, file, indent=2)
+        _last_snapshot = snapshot
+        return True
 
+async def snapshot_loop() -> None:
+    while True:
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+        if await session_backend.is_leader("metrics-snapshot"):
+            await asyncio.to_thread(export_metrics)
 
-def import_metrics() -> None:
-    with open(EXPORT_FILE_PATH, "r") as file:
+
+def __read_samples():
+    """ Stream `(metric_id, labels, value)` from the export (or the legacy JSON export). """
+    if os.path.exists(EXPORT_FILE_PATH):
+        with open(EXPORT_FILE_PATH, "r") as file:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+        return
+    
+    if not os.path.exists(LEGACY_EXPORT_FILE_PATH):
+        return
+    
+    with open(LEGACY_EXPORT_FILE_PATH, "r") as file:
         raw_data = file.read()
         if not raw_data:
             raw_data = "{}"
         data = json.loads(raw_data)
 
     for metric_id, samples in data.items():
+        for (labels, value) in samples:
+            yield (metric_id, labels, value)
+
+def import_metrics() -> None:
+    # Series exported with labels that are no longer used (e.g. client_id) are summed up.
+    merged_samples: dict[Gauge, dict[tuple, float]] = {}
+    
+    for (metric_id, labels, value) in __read_samples():
         metric: Gauge = REGISTRY._names_to_collectors.get(metric_id)
-        if not metric or not isinstance(metric, Gauge):
+        if not __is_persisted(metric):
             continue
         
-        for (labels, value) in samples:
+        labels = tuple((name, labels[name]) for name in metric._labelnames if name in labels)
+        metric_samples = merged_samples.setdefault(metric, {})
+        metric_samples[labels] = metric_samples.get(labels, 0) + value
+            
+    for metric, metric_samples in merged_samples.items():
+        for labels, value in metric_samples.items():
             if labels:
-                metric.labels(**labels).set(value)
+                metric.labels(**dict(labels)).set(value)
             else:
                 metric.set(value)
-            
\ No newline at end of file
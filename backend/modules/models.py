@@ -0,0 +1,77 @@
+from dataclasses import dataclass, field, fields
+
+
+# Explicit column projections, `select("*")` would also pull e.g. password hashes into quiz sessions.
+QUESTION_COLUMNS = "index,question,answer_a,answer_b,answer_c,correct_answer,media_name,category,points"
+CLIENT_SESSION_COLUMNS = "client_id,is_anon,practice_index,practice_seed,practice_hard_questions"
+CLIENT_AUTH_COLUMNS = "client_id,is_anon,name,password,logged_ips"
+
+
+@dataclass(slots=True)
+class Question:
+    index: int
+    question: str
+    answers: str | dict[str, str]  # "TN" or {"A": "...", "B": "...", "C": "..."}
+    correct_answer: str
+    media_name: str
+    category: str
+    points: int
+
+    @classmethod
+    def from_row(cls, row: dict) -> "Question":
+        """ Turn answer_a, answer_b, ... to: answers="TN"/{"A": "...", "B": "...", "C": "..."} """
+        if not row["answer_a"]:  # Tak/Nie
+            answers = "TN"
+        else:  # ABC
+            answers = {
+                "A": row["answer_a"],
+                "B": row["answer_b"],
+                "C": row["answer_c"],
+            }
+
+        return cls(
+            index=row["index"],
+            question=row["question"],
+            answers=answers,
+            correct_answer=row["correct_answer"],
+            media_name=row["media_name"],
+            category=row["category"],
+            points=row["points"],
+        )
+
+    def to_payload(self) -> dict:
+        """ Censored (without the correct answer) question data sent to the client. """
+        return {
+            "index": self.index,
+            "question": self.question,
+            "answers": self.answers,
+            "media_name": self.media_name,
+            "category": self.category,
+            "points": self.points,
+        }
+
+    def to_dict(self) -> dict:
+        payload = self.to_payload()
+        payload["correct_answer"] = self.correct_answer
+        return payload
+
+
+@dataclass(slots=True)
+class Client:
+    """ Row of the `Clients` table, only the selected columns are set. """
+    client_id: str
+    is_anon: bool = True
+    name: str | None = None
+    password: str | None = None
+    logged_ips: list[str] = field(default_factory=list)
+    practice_index: int = 0
+    practice_seed: int = 0
+    practice_hard_questions: list[int] = field(default_factory=list)  # `HardQuestions` during a practice session.
+    created_at: str | None = None
+
+    @classmethod
+    def from_row(cls, row: dict) -> "Client":
+        return cls(**{name: row[name] for name in _CLIENT_FIELDS if row.get(name) is not None})
+
+
+_CLIENT_FIELDS = tuple(client_field.name for client_field in fields(Client))
@@ -1,14 +1,45 @@
-from prometheus_client import Summary, Gauge
+from prometheus_client import Summary, Gauge, Counter, Histogram, CollectorRegistry, REGISTRY, multiprocess
 from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+from opentelemetry.sdk.trace.sampling import Sampler, SamplingResult, Decision, ParentBased, TraceIdRatioBased
+from opentelemetry.sdk.trace import TracerProvider, SpanProcessor, ReadableSpan, SpanLimits
 from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.sdk.trace import TracerProvider
 from opentelemetry.sdk.resources import Resource
+from opentelemetry.trace import StatusCode, TraceFlags
 from opentelemetry import trace
-from multiprocessing import Queue
-import logging_loki
+from collections import OrderedDict
 import logging
+import random
+import json
 import os
 
+from modules.log_shipping import LokiShipper, LokiHandler
+
+
+# Per-client_id labels create a new series for every (anonymous) visitor, per-client stats go to `client_stats_logger` (Loki)
+# and the `client_stats` of this process instead.
+METRICS_CLIENT_LABELS = os.getenv("METRICS_CLIENT_LABELS") == "true"
+CLIENT_STATS_MAX_CLIENTS = int(os.getenv("CLIENT_STATS_MAX_CLIENTS") or 10_000)
+
+QUESTION_LABELS = ["question_index", "client_id"] if METRICS_CLIENT_LABELS else ["question_index"]
+EXAM_LABELS = ["client_id"] if METRICS_CLIENT_LABELS else []
+
+# Head sampling of the new traces (child spans follow their parent), 1 - every trace.
+TRACE_SAMPLE_RATIO = float(os.getenv("TRACE_SAMPLE_RATIO") or 1)
+# Spans of the not sampled traces are still exported if they failed or took at least that long, 0 - disabled.
+TRACE_SLOW_SPAN_SECONDS = float(os.getenv("TRACE_SLOW_SPAN_SECONDS") or 0)
+TRACE_KEEP_ERRORS = (os.getenv("TRACE_KEEP_ERRORS") or "true") == "true"
+# Longer string span attributes are truncated (event attributes, e.g. exception stacktraces, are kept whole). Batch processor queue/batch sizes: standard OTEL_BSP_* env.
+TRACE_MAX_ATTRIBUTE_LENGTH = int(os.getenv("TRACE_MAX_ATTRIBUTE_LENGTH") or 256)
+
+# Level of every logger, overridden per logger with LOG_LEVEL_<NAME> (e.g. LOG_LEVEL_CLIENT_LOG=INFO).
+LOG_LEVEL = os.getenv("LOG_LEVEL") or "DEBUG"
+# Fraction of the per-message (hot path) logs which are emitted, e.g. 0.01 - every 100th message on average.
+LOG_MESSAGES_SAMPLE_RATE = float(os.getenv("LOG_MESSAGES_SAMPLE_RATE") or 1)
+
+# Set (before the start) for multi-worker deployments, every worker writes its samples to this directory.
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+
 class LogsEnrichment(logging.Filter):
     def filter(self, record):
         span = trace.get_current_span()
@@ -22,6 +53,79 @@ class LogsEnrichment(logging.Filter):
         return True
 
 
+class RecordOnlySampler(Sampler):
+    """ Decides on the DROPs of the `sampler`: RECORD_ONLY, the spans are recorded (for the tail rules), but not exported. """
+    
+    def __init__(self, sampler: Sampler) -> None:
+        self.sampler = sampler
+        
+    def should_sample(self, parent_context, trace_id, name, kind=None, attributes=None, links=None, trace_state=None) -> SamplingResult:
+        result = self.sampler.should_sample(parent_context, trace_id, name, kind, attributes, links, trace_state)
+        if result.decision == Decision.DROP:
+            return SamplingResult(Decision.RECORD_ONLY, attributes, result.trace_state)
+        return result
+    
+    def get_description(self) -> str:
+        return f"RecordOnly{{{self.sampler.get_description()}}}"
+
+
+class TailSpanProcessor(SpanProcessor):
+    """ Passes the sampled spans to the `processor`, and the recorded-only ones if they failed or were slow. """
+    
+    def __init__(self, processor: SpanProcessor, slow_span_seconds: float, keep_errors: bool) -> None:
+        self.processor = processor
+        self.slow_span_ns = int(slow_span_seconds * 1e9)
+        self.keep_errors = keep_errors
+        
+    def __is_kept(self, span: ReadableSpan) -> bool:
+        if self.keep_errors and span.status.status_code == StatusCode.ERROR:
+            return True
+        return self.slow_span_ns > 0 and span.end_time - span.start_time >= self.slow_span_ns
+        
+    def on_start(self, span, parent_context=None) -> None:
+        self.processor.on_start(span, parent_context)
+        
+    def on_end(self, span: ReadableSpan) -> None:
+        if span.context.trace_flags.sampled:
+            return self.processor.on_end(span)
+        
+        if self.__is_kept(span):
+            # Exporting processors skip spans without the sampled flag.
+            sampled_context = trace.SpanContext(span.context.trace_id, span.context.span_id, span.context.is_remote, TraceFlags(TraceFlags.SAMPLED), span.context.trace_state)
+            self.processor.on_end(ReadableSpan(
+                name=span.name, context=sampled_context, parent=span.parent, resource=span.resource,
+                attributes=span.attributes, events=span.events, links=span.links, kind=span.kind,
+                status=span.status, start_time=span.start_time, end_time=span.end_time,
+                instrumentation_scope=span.instrumentation_scope
+            ))
+            
+    def shutdown(self) -> None:
+        self.processor.shutdown()
+        
+    def force_flush(self, timeout_millis: int = 30000) -> bool:
+        return self.processor.force_flush(timeout_millis)
+
+
+class LogsSampling(logging.Filter):
+    def __init__(self, sample_rate: float) -> None:
+        super().__init__()
+        self.sample_rate = sample_rate
+        
+    def filter(self, record):
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+
+class LazyJSON:
+    """ Serialized only when the record is emitted: `logger.info("data=%s", LazyJSON(data))`. """
+    __slots__ = ("value",)
+    
+    def __init__(self, value) -> None:
+        self.value = value
+        
+    def __str__(self) -> str:
+        return json.dumps(self.value)
+
+
 class ColoredLogsFormatter(logging.Formatter):
     reset = "\x1b[0m"
     format = "%(levelname)s | %(asctime)s - %(message)s \033[90m(%(filename)s:%(lineno)d)"
@@ -40,19 +144,19 @@ class ColoredLogsFormatter(logging.Formatter):
         return formatter.format(record)
 
 
+def __log_level(logger_name: str) -> str | None:
+    """ LOG_LEVEL_<NAME> env of the logger, e.g. client-log.messages -> LOG_LEVEL_CLIENT_LOG_MESSAGES """
+    return os.getenv("LOG_LEVEL_" + logger_name.upper().replace("-", "_").replace(".", "_"))
+
 def __get_logger(name: str) -> logging.Logger:
-    loki_logs_handler = logging_loki.LokiQueueHandler(
-        Queue(-1),
-        url=os.getenv("LGTM_LOKI_API"),
-        tags={"app": name},
-        version="1",
-    )
-    loki_logs_handler.setFormatter(logging.Formatter('[%(name)s] %(asctime)s - %(levelname)s - %(message)s  trace_id=%(trace_id)s span_id=%(span_id)s'))
-    
     logger = logging.getLogger(name)
-    logger.setLevel(logging.DEBUG)
-    logger.addFilter(LogsEnrichment())
-    logger.addHandler(loki_logs_handler)
+    logger.setLevel(__log_level(name) or LOG_LEVEL)
+    
+    if loki_shipper is not None:
+        loki_logs_handler = LokiHandler(loki_shipper, tags={"app": name})
+        loki_logs_handler.setFormatter(logging.Formatter('[%(name)s] %(asctime)s - %(levelname)s - %(message)s  trace_id=%(trace_id)s span_id=%(span_id)s'))
+        loki_logs_handler.addFilter(LogsEnrichment())  # On the handler, so it also covers records of the child loggers.
+        logger.addHandler(loki_logs_handler)
     
     ch = logging.StreamHandler()
     ch.setFormatter(ColoredLogsFormatter())
@@ -60,57 +164,174 @@ def __get_logger(name: str) -> logging.Logger:
     
     return logger
 
+def __get_sampled_logger(parent: logging.Logger, name: str, sample_rate: float) -> logging.Logger:
+    """ Child logger (shares the handlers of `parent`) which emits only a `sample_rate` fraction of the records. """
+    logger = parent.getChild(name)
+    logger.setLevel(__log_level(logger.name) or logging.NOTSET)  # NOTSET - level of the `parent`.
+    logger.addFilter(LogsSampling(sample_rate))
+    return logger
+
 def __get_tracer() -> trace.Tracer:
     trace_resource = Resource.create({
         "service.name": "prawojazdy"
     })
-    trace.set_tracer_provider(TracerProvider(resource=trace_resource))
+    
+    sampler = TraceIdRatioBased(TRACE_SAMPLE_RATIO)
+    has_tail_rules = TRACE_SAMPLE_RATIO < 1 and (TRACE_KEEP_ERRORS or TRACE_SLOW_SPAN_SECONDS > 0)
+    if has_tail_rules:
+        sampler = ParentBased(RecordOnlySampler(sampler), local_parent_not_sampled=RecordOnlySampler(sampler))
+    else:
+        sampler = ParentBased(sampler)
+    
+    trace.set_tracer_provider(TracerProvider(
+        resource=trace_resource,
+        sampler=sampler,
+        span_limits=SpanLimits(max_span_attribute_length=TRACE_MAX_ATTRIBUTE_LENGTH)
+    ))
     tracer_provider = trace.get_tracer_provider()
     
     otlp_exporter = OTLPSpanExporter(endpoint=os.getenv("LGTM_OTEL_API"))
-    span_processor = BatchSpanProcessor(otlp_exporter)
+    span_processor = BatchSpanProcessor(otlp_exporter)  # Queue/batch sizes and delays from OTEL_BSP_* env.
+    if has_tail_rules:
+        span_processor = TailSpanProcessor(span_processor, TRACE_SLOW_SPAN_SECONDS, TRACE_KEEP_ERRORS)
     tracer_provider.add_span_processor(span_processor)
     return tracer_provider.get_tracer(__name__)
 
 
-# Loggers (Loki)
+# Loggers (Loki), records of all the loggers are shipped in batches by a single thread.
+loki_shipper = LokiShipper(os.getenv("LGTM_LOKI_API")) if os.getenv("LGTM_LOKI_API") else None
+
 client_logger = __get_logger("client-log")
 api_logger = __get_logger("api-log")
 db_logger = __get_logger("db-log")
 test_logger = __get_logger("test-log")
 
+# Per WS message/answer logs, use %-style arguments - they are formatted only if the record is emitted.
+client_message_logger = __get_sampled_logger(client_logger, "messages", LOG_MESSAGES_SAMPLE_RATE)
+# One not sampled logfmt record per answer/exam, source of the per-client dashboard (metrics are not labelled with client_id).
+client_stats_logger = __get_logger("client-stats")
+
 # Tracer (Tempo)
 tracer = __get_tracer()
 
 # Metrics (Prometheus -> Mimir)
-REQUEST_TIME_METRICS = Summary(
-    "request_processing_time", 
-    "Time spent processing the request.", 
-    ["endpoint"]
+# Histograms (unlike Summaries) aggregate across workers/instances and give quantiles with histogram_quantile().
+REQUEST_TIME_METRICS = Histogram(
+    "request_processing_time",
+    "Time spent processing the request.",
+    ["endpoint"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+
+EXAM_BUCKET_FETCH_TIME = Histogram(
+    "exam_bucket_fetch_seconds",
+    "Time spent fetching a single exam_* bucket from the database.",
+    ["bucket"],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
 )
 
 TOTAL_ANSWERS = Gauge(
     "quiz_total_answers", 
     "Total answers given per question.",
-    ["question_index", "client_id"]
+    QUESTION_LABELS,
+    multiprocess_mode="sum"
 )
 
 CORRECT_ANSWERS = Gauge(
     "quiz_correct_answers",
     "Correct answers given per question.",
-    ["question_index", "client_id"]
+    QUESTION_LABELS,
+    multiprocess_mode="sum"
 )
 
 INCORRECT_ANSWERS = Gauge(
     "quiz_incorrect_answers",
     "Incorrect answers given per question.",
-    ["question_index", "client_id"]
+    QUESTION_LABELS,
+    multiprocess_mode="sum"
 )
 
-TIME_ANSWERING = Summary(
+# Quantiles over all the questions, per question only the sum and count (a bucket set per question is too many series).
+TIME_ANSWERING = Histogram(
     "quiz_time_answering_seconds",
-    "Time spent answering each question.",
-    ["question_index", "client_id"]
+    "Time spent answering a question.",
+    buckets=(1, 2, 3, 5, 7.5, 10, 15, 20, 30, 45, 60, 120, 300)
+)
+
+QUESTION_TIME_ANSWERING = Counter(
+    "quiz_question_time_answering_seconds",
+    "Total time spent answering each question.",
+    QUESTION_LABELS
+)
+
+QUESTION_TIMED_ANSWERS = Counter(
+    "quiz_question_timed_answers",
+    "Answers counted in quiz_question_time_answering_seconds, per question.",
+    QUESTION_LABELS
+)
+
+QUESTION_BANK_HITS = Counter(
+    "question_bank_hits",
+    "Question lookups served from the in-process question bank."
+)
+
+QUESTION_BANK_MISSES = Counter(
+    "question_bank_misses",
+    "Question lookups that had to query the database."
+)
+
+MEDIA_CACHE_HITS = Counter(
+    "media_cache_hits",
+    "Media requests served from the in-process media cache."
+)
+
+MEDIA_CACHE_MISSES = Counter(
+    "media_cache_misses",
+    "Media requests that were not found in the media cache."
+)
+
+MEDIA_CACHE_BYTES_SERVED = Counter(
+    "media_cache_served_bytes",
+    "Bytes of media served from the media cache."
+)
+
+MEDIA_CACHE_EVICTIONS = Counter(
+    "media_cache_evictions",
+    "Media files evicted from the media cache."
+)
+
+SESSION_CACHE_HITS = Counter(
+    "session_cache_hits",
+    "Session validations served from the session cache."
+)
+
+SESSION_CACHE_MISSES = Counter(
+    "session_cache_misses",
+    "Session validations that had to query the database."
+)
+
+USERNAME_INDEX_NEGATIVES = Counter(
+    "username_index_negatives",
+    "Username checks answered as available by the in-memory index, without a database query."
+)
+
+OPEN_CONNECTIONS = Gauge(
+    "open_ws_connections",
+    "Currently open quiz WebSocket connections.",
+    ["mode"],
+    multiprocess_mode="livesum"  # Sum of the running workers, connections of the dead ones are closed.
+)
+
+BCRYPT_QUEUED = Gauge(
+    "bcrypt_queued_jobs",
+    "Password hashing/verification jobs submitted to the bcrypt workers (waiting or running).",
+    multiprocess_mode="livesum"  # Sum of the running workers, dead ones have no jobs.
+)
+
+BCRYPT_WAIT_TIME = Histogram(
+    "bcrypt_queue_wait_seconds",
+    "Time a password hashing/verification job waited for a bcrypt worker.",
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
 )
 
 TEST_TIME = Summary(
@@ -121,35 +342,138 @@ TEST_TIME = Summary(
 
 PASSED_TESTS = Gauge(
     "tests_passed",
-    "Total completly passed test sequences amount."
+    "Total completly passed test sequences amount.",
+    multiprocess_mode="sum"
 )
 
 FAILED_TESTS = Gauge(
     "tests_failed",
-    "Total failed tests amount."
+    "Total failed tests amount.",
+    multiprocess_mode="sum"
 )
 
 EXAM_PASSED = Gauge(
     "exam_passed",
     "Total passed exams",
-    ["client_id"]
+    EXAM_LABELS,
+    multiprocess_mode="sum"
 )
 
 EXAM_FAILED = Gauge(
     "exam_failed",
     "Total failed exams",
-    ["client_id"]
+    EXAM_LABELS,
+    multiprocess_mode="sum"
 )
 
-EXAM_TOTAL_TIME = Summary(
+EXAM_TOTAL_TIME = Histogram(
     "exam_total_time_seconds",
     "Time spent resolving the entire exam.",
-    ["client_id"]
-) 
+    EXAM_LABELS,
+    buckets=(60, 120, 180, 300, 450, 600, 900, 1200, 1500, 1800, 2400, 3600)
+)
 
-EXAM_POINTS = Summary(
+EXAM_POINTS = Histogram(
     "exam_points",
     "Amount of points in each exam",
-    ["client_id"]
+    EXAM_LABELS,
+    buckets=(10, 20, 30, 40, 50, 60, 64, 67, 70, 72, 74)  # 74 - max, 68 - passing.
 )
 
+# Totals restored after a restart by `metrics_persistance`, the other gauges describe the current state.
+PERSISTED_GAUGES = (
+    TOTAL_ANSWERS, CORRECT_ANSWERS, INCORRECT_ANSWERS,
+    PASSED_TESTS, FAILED_TESTS,
+    EXAM_PASSED, EXAM_FAILED,
+)
+
+
+def metrics_registry() -> CollectorRegistry:
+    """ Registry to expose, aggregates samples of all the workers in the multi-worker mode. """
+    if not PROMETHEUS_MULTIPROC_DIR:
+        return REGISTRY
+    
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+def mark_process_dead() -> None:
+    """ Drop the live gauges of this worker (multi-worker mode), call on shutdown. """
+    if PROMETHEUS_MULTIPROC_DIR:
+        multiprocess.mark_process_dead(os.getpid())
+
+
+class ClientStatsStore:
+    """ 
+    Per-client quiz statistics of this process (not shared between workers), bounded to `max_clients` least recently active clients.
+    Complete history of a client is in the `client_stats_logger` records.
+    """
+    
+    def __init__(self, max_clients: int) -> None:
+        self.max_clients = max_clients
+        self.__stats: OrderedDict[str, dict] = OrderedDict()
+        
+    def __get_entry(self, client_id: str) -> dict:
+        entry = self.__stats.get(client_id)
+        if entry is None:
+            entry = {
+                "total_answers": 0,
+                "correct_answers": 0,
+                "incorrect_answers": 0,
+                "time_answering_seconds": 0.0,
+                "exam_passed": 0,
+                "exam_failed": 0,
+                "exam_total_time_seconds": 0.0,
+                "exam_points": 0,
+            }
+            self.__stats[client_id] = entry
+            if len(self.__stats) > self.max_clients:
+                self.__stats.popitem(last=False)
+        else:
+            self.__stats.move_to_end(client_id)
+        return entry
+        
+    def record_answer(self, client_id: str, is_correct: bool, answering_time: float) -> None:
+        entry = self.__get_entry(client_id)
+        entry["total_answers"] += 1
+        entry["correct_answers" if is_correct else "incorrect_answers"] += 1
+        entry["time_answering_seconds"] += answering_time
+        
+    def record_exam(self, client_id: str, is_passed: bool, total_time: float, points: int) -> None:
+        entry = self.__get_entry(client_id)
+        entry["exam_passed" if is_passed else "exam_failed"] += 1
+        entry["exam_total_time_seconds"] += total_time
+        entry["exam_points"] += points
+        
+    def get(self, client_id: str) -> dict | None:
+        entry = self.__stats.get(client_id)
+        return entry.copy() if entry is not None else None
+
+
+client_stats = ClientStatsStore(CLIENT_STATS_MAX_CLIENTS)
+
+
+def __labelled(metric, **labels):
+    return metric.labels(**labels) if labels else metric
+
+def record_answer(question_index: int, client_id: str, is_correct: bool, answering_time: float) -> None:
+    labels = {"question_index": question_index}
+    if METRICS_CLIENT_LABELS:
+        labels["client_id"] = client_id
+    
+    __labelled(TOTAL_ANSWERS, **labels).inc()
+    TIME_ANSWERING.observe(answering_time)
+    __labelled(QUESTION_TIME_ANSWERING, **labels).inc(answering_time)
+    __labelled(QUESTION_TIMED_ANSWERS, **labels).inc()
+    __labelled(CORRECT_ANSWERS if is_correct else INCORRECT_ANSWERS, **labels).inc()
+    client_stats.record_answer(client_id, is_correct, answering_time)
+    client_stats_logger.info("event=answer client_id=%s question_index=%s is_correct=%s answering_time=%s", client_id, question_index, is_correct, answering_time)
+    
+def record_exam(client_id: str, is_passed: bool, total_time: float, points: int) -> None:
+    labels = {"client_id": client_id} if METRICS_CLIENT_LABELS else {}
+    
+    __labelled(EXAM_PASSED if is_passed else EXAM_FAILED, **labels).inc()
+    __labelled(EXAM_TOTAL_TIME, **labels).observe(total_time)
+    __labelled(EXAM_POINTS, **labels).observe(points)
+    client_stats.record_exam(client_id, is_passed, total_time, points)
+    client_stats_logger.info("event=exam client_id=%s is_passed=%s total_time=%s points=%s", client_id, is_passed, total_time, points)
@@ -0,0 +1,76 @@
+from contextlib import suppress
+import asyncio
+import os
+
+from modules.models import Client
+from modules import observability
+from modules import database
+
+
+PROGRESS_FLUSH_INTERVAL = float(os.environ.get("PROGRESS_FLUSH_INTERVAL") or 5)  # Seconds.
+
+# client_id: client with unsaved progress. Rows are built at flush time, so
+# any amount of changes between two flushes is coalesced into a single UPDATE.
+_pending_progress: dict[str, Client] = {}
+
+
+def queue_progress(client_data: Client) -> None:
+    _pending_progress[client_data.client_id] = client_data
+
+def __progress_row(client_data: Client) -> dict:
+    """ Only the columns changed by the quiz, e.g. `practice_seed` can be changed elsewhere in the meantime. """
+    return {
+        "practice_index": client_data.practice_index,
+        "practice_hard_questions": sorted(client_data.practice_hard_questions),
+    }
+
+def __requeue(batch: dict[str, Client], client_ids) -> None:
+    """ Progress queued since the batch was taken is newer, it is kept. """
+    for client_id in client_ids:
+        _pending_progress.setdefault(client_id, batch[client_id])
+
+async def flush_progress(client_id: str | None = None) -> None:
+    """ Write pending progress of all clients (or only `client_id`), failed or interrupted updates are requeued. """
+    if client_id is None:
+        batch = _pending_progress.copy()
+        _pending_progress.clear()
+    elif client_id in _pending_progress:
+        batch = {client_id: _pending_progress.pop(client_id)}
+    else:
+        return
+    
+    if not batch:
+        return
+    
+    try:
+        failed_client_ids = await database.update_clients_progress({pending_client_id: __progress_row(client_data) for pending_client_id, client_data in batch.items()})
+    except BaseException:  # Also cancellation, e.g. of the flush loop at shutdown - the batch is written by the next flush.
+        __requeue(batch, batch)
+        raise
+    
+    if failed_client_ids:
+        __requeue(batch, failed_client_ids)
+        return observability.db_logger.error(f"Failed to flush progress of total_clients={len(failed_client_ids)} of {len(batch)} (requeued)")
+
+    observability.db_logger.debug(f"Flushed progress of total_clients={len(batch)}")
+
+async def progress_flush_loop(stop: asyncio.Event) -> None:
+    """ Stopped with `stop` instead of cancellation, so the shutdown does not interrupt a flush in progress. """
+    while not stop.is_set():
+        with suppress(TimeoutError):
+            await asyncio.wait_for(stop.wait(), PROGRESS_FLUSH_INTERVAL)
+        await flush_progress()
+
+
+def set_practice_index(client_data: Client, index: int) -> None:
+    client_data.practice_index = index
+    queue_progress(client_data)
+
+def mark_as_hard_question(client_data: Client, question_index: int) -> None:
+    """ `practice_hard_questions` of the `client_data` has to be a `HardQuestions` instance. """
+    if client_data.practice_hard_questions.add(question_index):
+        queue_progress(client_data)
+    
+def unmark_as_hard_question(client_data: Client, question_index: int) -> None:
+    if client_data.practice_hard_questions.remove(question_index):
+        queue_progress(client_data)
@@ -1,13 +1,20 @@
 from abc import ABC, abstractmethod
+from functools import lru_cache
+from array import array
 import random
-import json
 import time
 import os
 
 from modules import observability
 from modules import database
+from modules import progress
+from modules import media
+from modules.hard_questions import HardQuestions
+from modules.models import Client, Question
 
 TOTAL_QUESTIONS = int(os.environ.get("TOTAL_QUESTIONS"))
+PRACTICE_LINES_CACHE_SIZE = int(os.environ.get("PRACTICE_LINES_CACHE_SIZE") or 1024)
+MEDIA_PREFETCH_COUNT = int(os.environ.get("MEDIA_PREFETCH_COUNT") or 2)  # 0 - no prefetch hints.
 
 
 def get_questions_manager_base(mode: str) -> "QuestionsManagerABC":
@@ -17,9 +24,22 @@ def get_questions_manager_base(mode: str) -> "QuestionsManagerABC":
         return PracticeManager
     
 
+@lru_cache(maxsize=PRACTICE_LINES_CACHE_SIZE)
+def get_practice_line(seed: int) -> array:
+    """ 
+    Shuffled practice questions line for the `seed`, shared by every session with this seed.
+    Stored as unsigned shorts (2B per question), the ordering is the same as `random.Random(seed).shuffle`.
+    """
+    questions_line = list(range(1, TOTAL_QUESTIONS))
+    random.Random(seed).shuffle(questions_line)  # Thread-safe
+    return array("H", questions_line)
+    
+
 class QuestionsManagerABC(ABC):
-    client_data: dict
-    current_question: dict | None = None
+    client_data: Client
+    client_id: str
+    current_question: Question | None = None
+    response_span_name: str
     response_span: observability.trace.Span | None = None 
     question_sent_time: float | None = None
     
@@ -27,66 +47,103 @@ class QuestionsManagerABC(ABC):
         ...
     
     @abstractmethod
-    async def provide_question(self) -> tuple[str, dict]:
-        ...
+    async def provide_question(self, start_answering: bool = True) -> tuple[str, dict]:
+        """ `start_answering=False` - the question is shown later, the client acknowledges it with QUESTION_SHOWN. """
+        
+    def start_answering(self, started_at: float | None = None) -> None:
+        """ Start measuring the answer to the `current_question` (answering time and the response span). """
+        self.question_sent_time = started_at or time.time()
+        self.response_span = observability.tracer.start_span(
+            self.response_span_name,
+            attributes={"client_id": self.client_id, "question_index": self.current_question.index},
+            start_time=int(self.question_sent_time * 1e9)
+        )
+        
+    def question_shown(self) -> None:
+        """ QUESTION_SHOWN - the question provided with `start_answering=False` is now displayed by the client. """
+        if self.response_span is None and self.current_question is not None:
+            self.start_answering()
+            
+    def ensure_answering_started(self) -> None:
+        """ Clients which do not acknowledge the delayed questions are measured from the moment it was sent. """
+        if self.response_span is None:
+            self.start_answering(self.question_sent_time)
         
     @abstractmethod
     async def handle_answer(self) -> dict | str:
         ...
+        
+    def upcoming_media_names(self, count: int) -> list[str]:
+        return []
+    
+    def upcoming_media(self) -> list[dict]:
+        """ Media (with sizes) of the next questions, which the client can prefetch. """
+        upcoming_media = []
+        for media_name in self.upcoming_media_names(MEDIA_PREFETCH_COUNT):
+            media_size = media.get_media_size(media_name)
+            if media_size is not None:
+                upcoming_media.append({"media_name": media_name, "size": media_size})
+        return upcoming_media
     
     
 
 class PracticeManager(QuestionsManagerABC):
-    def __init__(self, client_data: dict) -> None:
+    response_span_name = "quiz-practice-response"
+    
+    def __init__(self, client_data: Client) -> None:
         self.client_data = client_data
-        self.client_id = client_data['client_id']
+        self.client_id = client_data.client_id
+        self.hard_questions = HardQuestions(client_data.practice_hard_questions)
+        self.client_data.practice_hard_questions = self.hard_questions
+        self.current_is_hard = False
         self.prepare_questions_line()
 
-    async def provide_question(self) -> tuple[str, dict]:
+    async def provide_question(self, start_answering: bool = True) -> tuple[str, dict]:
         is_inserting_hard = self.should_insert_hard_question()
-        hard_questions = self.client_data["practice_hard_questions"]
+        self.hard_questions.advance()
         
         if is_inserting_hard:
-            question_index = hard_questions[0]
-            observability.client_logger.debug(f"Hard question question_index={question_index} inserted to the line for client_id={self.client_id}")
+            question_index = self.hard_questions.sample()
+            observability.client_message_logger.debug("Hard question question_index=%s inserted to the line for client_id=%s", question_index, self.client_id)
         else:
-            question_index = self.questions_line[self.client_data['practice_index']]
+            question_index = self.questions_line[self.client_data.practice_index]
             
-        question_data = await database.fetch_question(question_index)
-        question_data['is_hard'] = is_inserting_hard
+        self.current_question = await database.fetch_question(question_index)
+        self.current_is_hard = is_inserting_hard
         
-        question_data["number"] = self.client_data['practice_index']
-        question_data["_total_hard"] = len(hard_questions)
+        question_data = self.current_question.to_payload()
+        question_data['is_hard'] = is_inserting_hard
+        question_data["number"] = self.client_data.practice_index
+        question_data["_total_hard"] = len(self.hard_questions)
 
-        self.current_question = question_data.copy()
-        self.response_span = observability.tracer.start_span("quiz-practice-response", attributes={"client_id": self.client_id, "question_index": question_index})
+        self.response_span = None
         self.question_sent_time = time.time()
+        if start_answering:
+            self.start_answering()
         
-        observability.client_logger.info(f"Sending censored mode=practice question_index={question_index} question_data='{json.dumps(question_data)}' for client_id={self.client_id}")
-        del question_data["correct_answer"]
+        observability.client_message_logger.info("Sending censored mode=practice question_index=%s question_data='%s' correct_answer=%s for client_id=%s", question_index, observability.LazyJSON(question_data), self.current_question.correct_answer, self.client_id)
     
         return ("QUESTION_DATA", question_data)
     
     async def handle_answer(self, answer: str):
-        question_index = self.current_question['index']
+        question_index = self.current_question.index
 
-        if not self.current_question['is_hard']:
+        if not self.current_is_hard:
             await self.increment_question_index()
             
         # Observability.
+        self.ensure_answering_started()
         self.response_span.add_event("Received response", attributes={"answer": answer, "question_index": question_index})
         answering_time = time.time() - self.question_sent_time
-        observability.TOTAL_ANSWERS.labels(question_index=question_index, client_id=self.client_id).inc()
-        observability.TIME_ANSWERING.labels(question_index=question_index, client_id=self.client_id).observe(answering_time)
         
         # Correct answer.
-        if answer == self.current_question['correct_answer']:
-            if self.current_question["is_hard"]:
-                observability.client_logger.debug(f"Correctly answered question_index={question_index} was marked as HARD by client_id={self.client_id}. Unmarking...")
-                self.client_data['practice_hard_questions'] = await database.unmark_as_hard_question(self.client_data, question_index)
+        if answer == self.current_question.correct_answer:
+            if self.current_is_hard:
+                observability.client_message_logger.debug("Correctly answered question_index=%s was marked as HARD by client_id=%s. Unmarking...", question_index, self.client_id)
+                progress.unmark_as_hard_question(self.client_data, question_index)
     
-            observability.client_logger.info(f"Correct mode=practice answer={answer} for question_index={question_index} by client_id={self.client_id} answering took time={answering_time} seconds")
-            observability.CORRECT_ANSWERS.labels(question_index=question_index, client_id=self.client_id).inc()
+            observability.client_message_logger.info("Correct mode=practice answer=%s for question_index=%s by client_id=%s answering took time=%s seconds", answer, question_index, self.client_id, answering_time)
+            observability.record_answer(question_index, self.client_id, True, answering_time)
             self.response_span.end()
 
             return {
@@ -97,43 +154,52 @@ class PracticeManager(QuestionsManagerABC):
             
         # Incorrect answer.
         else:
-            if not self.current_question["is_hard"]:
-                observability.client_logger.debug(f"Inorrectly answered question_index={question_index} is being marked as HARD by client_id={self.client_id}. Marking...")
-                self.client_data['practice_hard_questions'] = await database.mark_as_hard_question(self.client_data, question_index)
+            observability.client_message_logger.debug("Inorrectly answered question_index=%s is being marked as HARD by client_id=%s. Marking...", question_index, self.client_id)
+            progress.mark_as_hard_question(self.client_data, question_index)
     
-            observability.client_logger.info(f"Incorrect mode=practice answer={answer} for question_index={question_index} by client_id={self.client_id} answering took time={answering_time} seconds")
-            observability.INCORRECT_ANSWERS.labels(question_index=question_index, client_id=self.client_id).inc()
+            observability.client_message_logger.info("Incorrect mode=practice answer=%s for question_index=%s by client_id=%s answering took time=%s seconds", answer, question_index, self.client_id, answering_time)
+            observability.record_answer(question_index, self.client_id, False, answering_time)
             self.response_span.end()
 
             return {
                 "is_correct": False,
-                "correct_answer": self.current_question['correct_answer'],
+                "correct_answer": self.current_question.correct_answer,
                 "given_answer": answer
             }
     
-    def prepare_questions_line(self) -> list[int]:
-        self.questions_line = list(range(1, TOTAL_QUESTIONS))
-        random.Random(self.client_data['practice_seed']).shuffle(self.questions_line)  # Thread-safe
-        observability.client_logger.debug(f"Shuffled questions for client_id={self.client_id} with seed={self.client_data['practice_seed']}. The questions line starts with: shuffled_line='{self.questions_line[:3]}'")
+    def upcoming_media_names(self, count: int) -> list[str]:
+        # Hard questions do not move the line, the next regular question is still at `practice_index`.
+        next_position = self.client_data.practice_index + (0 if self.current_is_hard else 1)
+        
+        media_names = []
+        for question_index in self.questions_line[next_position:next_position + count]:
+            question = database.get_cached_question(question_index)
+            if question is not None and question.media_name:
+                media_names.append(question.media_name)
+        return media_names
+    
+    def prepare_questions_line(self) -> None:
+        self.questions_line = get_practice_line(self.client_data.practice_seed)
+        observability.client_logger.debug("Shuffled questions for client_id=%s with seed=%s. The questions line starts with: shuffled_line='%s'", self.client_id, self.client_data.practice_seed, self.questions_line[:3].tolist())
 
     async def increment_question_index(self) -> None:
-        self.client_data['practice_index'] += 1
-        await database.set_practice_index(self.client_id, self.client_data['practice_index'])
-        observability.client_logger.info(f"Incremented practice_index={self.client_data['practice_index']} for client_id={self.client_id}")
+        progress.set_practice_index(self.client_data, self.client_data.practice_index + 1)
+        observability.client_message_logger.info("Incremented practice_index=%s for client_id=%s", self.client_data.practice_index, self.client_id)
 
     def should_insert_hard_question(self) -> bool:
-        hard_questions = self.client_data['practice_hard_questions']
-        hard_questions_percentage = len(hard_questions) / TOTAL_QUESTIONS
-        observability.client_logger.debug(f"Chance for hard question for client_id={self.client_id} with total_hard_questions={len(hard_questions)} is: hard_question_chance={hard_questions_percentage}")
-        return hard_questions and random.random() < hard_questions_percentage
+        hard_questions_percentage = len(self.hard_questions) / TOTAL_QUESTIONS
+        observability.client_message_logger.debug("Chance for hard question for client_id=%s with total_hard_questions=%s is: hard_question_chance=%s", self.client_id, len(self.hard_questions), hard_questions_percentage)
+        return len(self.hard_questions) > 0 and random.random() < hard_questions_percentage
 
 
 class ExamManager(QuestionsManagerABC):
-    def __init__(self, client_data: dict) -> None:
+    response_span_name = "quiz-exam-response"
+    
+    def __init__(self, client_data: Client) -> None:
         self.client_data = client_data
-        self.client_id = client_data['client_id']
+        self.client_id = client_data.client_id
 
-        self.questions_line = []
+        self.questions_line: list[Question] = []
         self.line_index = 0
         self.points = 0
         self.incorrect = []
@@ -142,66 +208,62 @@ class ExamManager(QuestionsManagerABC):
     async def initialize(self) -> None:
         self.questions_line = await database.generate_exam_line()
         
-    async def provide_question(self) -> tuple[str, dict]:
+    async def provide_question(self, start_answering: bool = True) -> tuple[str, dict]:
         if self.line_index > len(self.questions_line) - 1:
-            if self.points >= 68:
-                observability.EXAM_PASSED.labels(client_id=self.client_id).inc()
-            else:
-                observability.EXAM_FAILED.labels(client_id=self.client_id).inc()
-                
             total_time_s = time.time() - self.start_time  
-            observability.EXAM_TOTAL_TIME.labels(client_id=self.client_id).observe(total_time_s)
-
-            observability.EXAM_POINTS.labels(client_id=self.client_id).observe(self.points)
+            observability.record_exam(self.client_id, self.points >= 68, total_time_s, self.points)
             
             return (
                 "EXAM_FINISH",
                 self.prepare_exam_result()  
             )
             
-        question_data = self.questions_line[self.line_index]
-
-        self.current_question = question_data.copy()
-        self.response_span = observability.tracer.start_span("quiz-exam-response", attributes={"client_id": self.client_id, "question_index": question_data['index']})
+        self.current_question = self.questions_line[self.line_index]
+        self.response_span = None
         self.question_sent_time = time.time()
+        if start_answering:
+            self.start_answering()
         
-        observability.client_logger.info(f"Sending censored mode=exam question_index={question_data['index']} question_data='{json.dumps(question_data)}' for client_id={self.client_id}")
-        del question_data["correct_answer"]
+        question_data = self.current_question.to_payload()
         question_data['number'] = self.line_index + 1
+        observability.client_message_logger.info("Sending censored mode=exam question_index=%s question_data='%s' correct_answer=%s for client_id=%s", self.current_question.index, observability.LazyJSON(question_data), self.current_question.correct_answer, self.client_id)
         self.line_index += 1
 
         return ("QUESTION_DATA", question_data)
     
     async def handle_answer(self, answer: str) -> str:
-        question_index = self.current_question['index']
+        question_index = self.current_question.index
         
         # Observability.
+        self.ensure_answering_started()
         self.response_span.add_event("Received response", attributes={"answer": answer, "question_index": question_index})
         answering_time = time.time() - self.question_sent_time
-        observability.TOTAL_ANSWERS.labels(question_index=question_index, client_id=self.client_id).inc()
-        observability.TIME_ANSWERING.labels(question_index=question_index, client_id=self.client_id).observe(answering_time)
         
         # Correct answer.
-        if answer == self.current_question['correct_answer']:
-            observability.client_logger.info(f"Correct mode=exam answer={answer} for question_index={question_index} by client_id={self.client_id} answering took time={answering_time} seconds")
-            observability.CORRECT_ANSWERS.labels(question_index=question_index, client_id=self.client_id).inc()
+        if answer == self.current_question.correct_answer:
+            observability.client_message_logger.info("Correct mode=exam answer=%s for question_index=%s by client_id=%s answering took time=%s seconds", answer, question_index, self.client_id, answering_time)
+            observability.record_answer(question_index, self.client_id, True, answering_time)
             self.response_span.end()
             
-            self.points += self.current_question['points']
+            self.points += self.current_question.points
             
         # Incorrect answer.
         else:
-            observability.client_logger.info(f"Incorrect mode=exam answer={answer} for question_index={question_index} by client_id={self.client_id} answering took time={answering_time} seconds")
-            observability.INCORRECT_ANSWERS.labels(question_index=question_index, client_id=self.client_id).inc()
+            observability.client_message_logger.info("Incorrect mode=exam answer=%s for question_index=%s by client_id=%s answering took time=%s seconds", answer, question_index, self.client_id, answering_time)
+            observability.record_answer(question_index, self.client_id, False, answering_time)
             self.response_span.end()
             
-            question_data_dump = self.current_question.copy()
+            question_data_dump = self.current_question.to_dict()
             question_data_dump['client_answer'] = answer
             
             self.incorrect.append(question_data_dump)
 
         return "OK"
         
+    def upcoming_media_names(self, count: int) -> list[str]:
+        upcoming_questions = self.questions_line[self.line_index:self.line_index + count]
+        return [question.media_name for question in upcoming_questions if question.media_name]
+        
     def prepare_exam_result(self) -> dict:
         is_passed = self.points >= 68
 
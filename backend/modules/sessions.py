@@ -0,0 +1,215 @@
+from abc import ABC, abstractmethod
+from collections.abc import Awaitable, Callable
+import asyncio
+import socket
+import uuid
+import os
+
+from modules import observability
+
+
+SESSION_BACKEND_URL = os.environ.get("SESSION_BACKEND_URL")  # redis://... - shared between workers, unset - in-process.
+SESSION_TTL = int(os.environ.get("SESSION_TTL") or 60)  # Seconds, owned sessions are refreshed every SESSION_TTL/3.
+LEADERSHIP_TTL = int(os.environ.get("LEADERSHIP_TTL") or 90)  # Seconds.
+SESSION_TAKEOVER_TIMEOUT = float(os.environ.get("SESSION_TAKEOVER_TIMEOUT") or 5)  # Seconds, wait for the previous owner to hand the session over.
+
+WORKER_ID = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+# `client_id` of a session taken over by another worker.
+TakeoverCallback = Callable[[str], Awaitable[None]]
+# `client_ids` with stale cached session validations (logout/login/removal on another worker).
+InvalidationCallback = Callable[[list[str]], None]
+
+
+class SessionBackend(ABC):
+    """
+    Which worker owns the WS session of a client and which worker runs the singleton jobs (e.g. cleaners).
+    Ownership of sessions and leadership expire unless refreshed, so a crashed worker does not hold them forever.
+    """
+
+    async def start(self, on_takeover: TakeoverCallback, on_invalidation: InvalidationCallback) -> None:
+        """ 
+        `on_takeover` is awaited when another worker claims a session owned by this worker,
+        it has to close the session and save its progress - the claim of the other worker waits for it.
+        `on_invalidation` is called with the `client_ids` invalidated by another worker.
+        """
+
+    async def stop(self) -> None:
+        ...
+
+    async def invalidate(self, client_ids: list[str]) -> None:
+        """ Tell the other workers that their cached session validations of the `client_ids` are stale. """
+
+    @abstractmethod
+    async def claim(self, client_id: str) -> str | None:
+        """ 
+        Take the session over, returns the previous owner (worker ID) if there was one.
+        If it was another worker, returns once it handed the session over (or after SESSION_TAKEOVER_TIMEOUT).
+        """
+
+    @abstractmethod
+    async def release(self, client_id: str) -> None:
+        """ No-op if the session is owned by another worker. """
+
+    @abstractmethod
+    async def refresh(self, client_ids: list[str]) -> None:
+        ...
+
+    @abstractmethod
+    async def connected_among(self, client_ids: list[str]) -> set[str]:
+        """ Which of the `client_ids` are connected to any worker. """
+
+    @abstractmethod
+    async def is_leader(self, role: str) -> bool:
+        """ Acquire or keep the leadership of the `role`, has to be called at least every LEADERSHIP_TTL. """
+
+
+class LocalSessionBackend(SessionBackend):
+    """ Single process deployments and tests, takeovers are handled by the `HandlerRegistry` itself. """
+
+    def __init__(self) -> None:
+        self.__owned: set[str] = set()
+
+    async def claim(self, client_id: str) -> str | None:
+        previous_owner = WORKER_ID if client_id in self.__owned else None
+        self.__owned.add(client_id)
+        return previous_owner
+
+    async def release(self, client_id: str) -> None:
+        self.__owned.discard(client_id)
+
+    async def refresh(self, client_ids: list[str]) -> None:
+        ...
+
+    async def connected_among(self, client_ids: list[str]) -> set[str]:
+        return self.__owned.intersection(client_ids)
+
+    async def is_leader(self, role: str) -> bool:
+        return True
+
+
+class RedisSessionBackend(SessionBackend):
+    """ 
+    Sessions as `ws-session:{client_id}` = worker ID keys with TTL, takeovers are published on a channel
+    and the previous owner acknowledges them on another one once the session is closed and its progress saved.
+    """
+
+    TAKEOVER_CHANNEL = "ws-session-takeover"  # "{previous_owner} {new_owner} {client_id}"
+    HANDOVER_CHANNEL = "ws-session-handover"  # "{new_owner} {client_id}"
+    INVALIDATION_CHANNEL = "session-cache-invalidation"  # "{worker_id} {client_id},{client_id},..."
+
+    # Delete/refresh only if owned by ARGV[1].
+    RELEASE_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+    REFRESH_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('expire', KEYS[1], ARGV[2]) end return 0"
+    LEADERSHIP_SCRIPT = """
+        if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('expire', KEYS[1], ARGV[2]) end
+        if redis.call('set', KEYS[1], ARGV[1], 'NX', 'EX', ARGV[2]) then return 1 end
+        return 0
+    """
+
+    def __init__(self, url: str) -> None:
+        try:
+            import redis.asyncio
+        except ImportError as error:
+            raise ImportError("SESSION_BACKEND_URL requires the `redis` package (pip install redis)") from error
+
+        self.__redis = redis.asyncio.from_url(url, decode_responses=True)
+        self.__listener: asyncio.Task | None = None
+        self.__handovers: dict[str, asyncio.Future] = {}  # client_id: claim of this worker waiting for the previous owner.
+        self.__handover_tasks: set[asyncio.Task] = set()
+
+    @staticmethod
+    def __key(client_id: str) -> str:
+        return f"ws-session:{client_id}"
+
+    async def start(self, on_takeover: TakeoverCallback, on_invalidation: InvalidationCallback) -> None:
+        pubsub = self.__redis.pubsub()
+        await pubsub.subscribe(self.TAKEOVER_CHANNEL, self.HANDOVER_CHANNEL, self.INVALIDATION_CHANNEL)
+        self.__listener = asyncio.create_task(self.__listen(pubsub, on_takeover, on_invalidation))
+
+    async def __listen(self, pubsub, on_takeover: TakeoverCallback, on_invalidation: InvalidationCallback) -> None:
+        async for message in pubsub.listen():
+            if message["type"] != "message":
+                continue
+
+            if message["channel"] == self.INVALIDATION_CHANNEL:
+                sender, _, client_ids = message["data"].partition(" ")
+                if sender != WORKER_ID:
+                    on_invalidation(client_ids.split(","))
+                continue
+
+            if message["channel"] == self.HANDOVER_CHANNEL:
+                new_owner, _, client_id = message["data"].partition(" ")
+                handover = self.__handovers.get(client_id)
+                if new_owner == WORKER_ID and handover is not None and not handover.done():
+                    handover.set_result(None)
+                continue
+
+            previous_owner, new_owner, client_id = message["data"].split(" ", 2)
+            if previous_owner == WORKER_ID:  # In a task, a slow handover must not hold up the other messages.
+                handover_task = asyncio.create_task(self.__hand_over(on_takeover, new_owner, client_id))
+                self.__handover_tasks.add(handover_task)
+                handover_task.add_done_callback(self.__handover_tasks.discard)
+
+    async def __hand_over(self, on_takeover: TakeoverCallback, new_owner: str, client_id: str) -> None:
+        try:
+            await on_takeover(client_id)
+        except Exception as error:
+            observability.api_logger.error(f"Failed to hand over session of client_id={client_id} to worker_id={new_owner}: {error}")
+        await self.__redis.publish(self.HANDOVER_CHANNEL, f"{new_owner} {client_id}")
+
+    async def stop(self) -> None:
+        if self.__listener is not None:
+            self.__listener.cancel()
+        await asyncio.gather(*self.__handover_tasks, return_exceptions=True)
+        await self.__redis.aclose()
+
+    async def invalidate(self, client_ids: list[str]) -> None:
+        if client_ids:
+            await self.__redis.publish(self.INVALIDATION_CHANNEL, f"{WORKER_ID} {','.join(client_ids)}")
+
+    async def claim(self, client_id: str) -> str | None:
+        previous_owner = await self.__redis.set(self.__key(client_id), WORKER_ID, ex=SESSION_TTL, get=True)
+        if previous_owner is None or previous_owner == WORKER_ID:
+            return previous_owner
+        
+        handover = asyncio.get_running_loop().create_future()
+        self.__handovers[client_id] = handover
+        try:
+            await self.__redis.publish(self.TAKEOVER_CHANNEL, f"{previous_owner} {WORKER_ID} {client_id}")
+            await asyncio.wait_for(handover, SESSION_TAKEOVER_TIMEOUT)
+        except TimeoutError:  # E.g. the previous owner crashed, its session key just has not expired yet.
+            observability.api_logger.warning(f"Worker worker_id={previous_owner} did not hand over session of client_id={client_id} in time, taking it over anyway...")
+        finally:
+            if self.__handovers.get(client_id) is handover:
+                del self.__handovers[client_id]
+        return previous_owner
+
+    async def release(self, client_id: str) -> None:
+        await self.__redis.eval(self.RELEASE_SCRIPT, 1, self.__key(client_id), WORKER_ID)
+
+    async def refresh(self, client_ids: list[str]) -> None:
+        async with self.__redis.pipeline(transaction=False) as pipeline:
+            for client_id in client_ids:
+                pipeline.eval(self.REFRESH_SCRIPT, 1, self.__key(client_id), WORKER_ID, SESSION_TTL)
+            await pipeline.execute()
+
+    async def connected_among(self, client_ids: list[str]) -> set[str]:
+        if not client_ids:
+            return set()
+
+        owners = await self.__redis.mget([self.__key(client_id) for client_id in client_ids])
+        return {client_id for client_id, owner in zip(client_ids, owners) if owner is not None}
+
+    async def is_leader(self, role: str) -> bool:
+        return bool(await self.__redis.eval(self.LEADERSHIP_SCRIPT, 1, f"leader:{role}", WORKER_ID, LEADERSHIP_TTL))
+
+
+def create_session_backend() -> SessionBackend:
+    if SESSION_BACKEND_URL:
+        observability.api_logger.info(f"Using shared session backend for worker_id={WORKER_ID}")
+        return RedisSessionBackend(SESSION_BACKEND_URL)
+    return LocalSessionBackend()
+
+
+session_backend = create_session_backend()
@@ -1,24 +1,69 @@
+import dotenv
+import glob
+import os
+
+dotenv.load_dotenv(".env")  # Before `prometheus_client`, which reads PROMETHEUS_MULTIPROC_DIR on import.
+
+if __name__ == "__main__" and os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+    # Samples of the previous run would be summed up with the restored ones. Before any metric (and its file) is created.
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+    for samples_path in glob.glob(os.path.join(os.environ["PROMETHEUS_MULTIPROC_DIR"], "*.db")):
+        os.remove(samples_path)
+
 from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
 from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
 from fastapi import FastAPI, Response, WebSocket, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
+from contextlib import asynccontextmanager, suppress
 import uvicorn
-import dotenv
-import os
-
-dotenv.load_dotenv(".env")
+import asyncio
 
+from modules.sessions import session_backend, SESSION_BACKEND_URL
 from modules import metrics_persistance
 from modules import observability
 from modules import connection
 from modules import questions
 from modules import accounts
-
-metrics_persistance.import_metrics()
-
-
-api = FastAPI()
+from modules import progress
+from modules import database
+from modules import media
+
+WEB_WORKERS = int(os.environ.get("WEB_WORKERS") or 1)
+
+# Every worker imports this module, in the multi-worker mode gauges are restored only once - by the main process.
+if __name__ == "__main__" or not observability.PROMETHEUS_MULTIPROC_DIR:
+    metrics_persistance.import_metrics()
+
+
+@asynccontextmanager
+async def lifespan(api: FastAPI):
+    progress_flush_stop = asyncio.Event()
+    progress_flush_task = asyncio.create_task(progress.progress_flush_loop(progress_flush_stop))
+    background_tasks = [
+        asyncio.create_task(metrics_persistance.snapshot_loop()),
+        asyncio.create_task(connection.orphan_connection_handlers_cleaner()),
+        asyncio.create_task(connection.forgotten_anon_accounts_cleaner()),
+        asyncio.create_task(connection.session_refresh_loop()),
+    ]
+    await session_backend.start(connection.abort_taken_over_handler, accounts.drop_cached_sessions)
+    await accounts.load_username_index()
+    await asyncio.to_thread(media.prewarm_media_cache, database.get_exam_media_names())
+    yield
+    progress_flush_stop.set()  # Not cancelled - lets a flush in progress finish, the loop flushes once more and returns.
+    for task in background_tasks:
+        task.cancel()
+    for task in background_tasks:  # The final flush/export must not overlap with the last periodic one.
+        with suppress(asyncio.CancelledError):
+            await task
+    await progress_flush_task
+    await session_backend.stop()
+    await progress.flush_progress()
+    await asyncio.to_thread(metrics_persistance.export_metrics)
+    observability.mark_process_dead()
+
+
+api = FastAPI(lifespan=lifespan)
 api.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -36,7 +81,7 @@ async def measure_response_time(request: Request, call_next):
 
 def api_response(status: bool, content: str | dict | None = None) -> JSONResponse:
     status_code = 200 if status else 400
-    observability.api_logger.debug(f"Sending API Response status_code={status_code} content={content}")
+    observability.api_logger.debug("Sending API Response status_code=%s content=%s", status_code, content)
         
     return JSONResponse({
         "status": status,
@@ -50,19 +95,28 @@ async def get_home() -> Response:
 
 @api.get("/metrics")
 async def metrics():
-    metrics_persistance.export_metrics()
-    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+    return Response(generate_latest(observability.metrics_registry()), media_type=CONTENT_TYPE_LATEST)
+
+@api.get("/metrics/client/{client_id}")
+async def get_client_metrics(client_id: str, request: Request) -> JSONResponse:
+    iphash = accounts.hash_ip(request.client.host)
+    if await accounts.validate_session(client_id, iphash) is None:
+        return api_response(False, "Brak dostępu.")
+    
+    stats = observability.client_stats.get(client_id)
+    if stats is None:
+        return api_response(False, "Brak statystyk.")
+    return api_response(True, stats)
 
 @api.get("/media/{media_name}")
 async def static_media(media_name: str, request: Request) -> Response:
-    path = "../media/" + media_name
-    if not os.path.exists(path):
+    response = await media.media_response(media_name, request)
+    if response is None:
         observability.api_logger.error(f"Failed to access media: medianame={media_name} from client_host={request.client.host} (FILE NOT FOUND)")
         return Response(None, 404)
     
-    with open(path, "rb") as file:
-        observability.api_logger.info(f"Accessing media: medianame={media_name} from: client_host={request.client.host}")
-        return Response(file.read(), media_type="video/mp4")
+    observability.api_logger.info("Accessing media: medianame=%s from: client_host=%s", media_name, request.client.host)
+    return response
 
 @api.get("/test-result/{result}/{total_time}/{n_workers}")
 async def get_test_result(result: str, total_time: float, n_workers: int) -> Response:
@@ -97,7 +151,7 @@ async def post_account_register(data: accounts.AccountRegisterModel, request: Re
     if len(data.password) < 3:
         return api_response(False, "Zbyt krótkie hasło.")
 
-    if await accounts.get_client_by_name(data.username) is not None:
+    if await accounts.username_exists(data.username, confirm_missing=WEB_WORKERS > 1):
         return api_response(False, "Ta nazwa użytkownika jest już zajęta.")
 
     iphash = accounts.hash_ip(request.client.host)
@@ -111,36 +165,30 @@ async def post_account_register(data: accounts.AccountRegisterModel, request: Re
 async def post_account_login(data: accounts.AccountLoginModel, request: Request) -> JSONResponse:
     iphash = accounts.hash_ip(request.client.host)
 
-    if not await accounts.login_account(data.username, data.password, iphash):
+    client_id = await accounts.login_account(data.username, data.password, iphash)
+    if client_id is None:
         return api_response(False, "Nieprawidłowa nazwa użytkownika lub hasło.")
 
-    account = await accounts.get_client_by_name(data.username)
-    return api_response(True, account['client_id'])
+    return api_response(True, client_id)
         
 @api.get("/account/check-username/{username}")
 async def post_account_login(username: str, request: Request) -> JSONResponse:
-    is_account = await accounts.get_client_by_name(username) is not None
+    is_account = await accounts.username_exists(username)
     return api_response(is_account)
 
 @api.get("/account/validate-session/{client_id}")
 async def get_account_validate_session(client_id: str = None, request: Request = None) -> JSONResponse:
+    iphash = accounts.hash_ip(request.client.host)
     if not client_id:
         observability.client_logger.warning(f"client tried to validate session with no client_id set by iphash={iphash}")
         return api_response(False)
     
-    iphash = accounts.hash_ip(request.client.host)
-    account = await accounts.get_client_by_id(client_id)
-    
-    if account is None:
-        observability.client_logger.warning(f"session validation failed for client_id={client_id} by iphash={iphash} (account not found)")
-        return api_response(False)
-    
-    if iphash not in account['logged_ips']:
-        observability.client_logger.warning(f"session validation failed for client_id={client_id} by iphash={iphash}")
+    username = await accounts.validate_session(client_id, iphash)
+    if username is None:
         return api_response(False)
 
     observability.client_logger.info(f"successfull session validation for client_id={client_id} by iphash={iphash}")
-    return api_response(True, {"username": account['name']})
+    return api_response(True, {"username": username})
 
 @api.get("/account/logout/{client_id}")
 async def get_account_logout(client_id: str, request: Request) -> JSONResponse:
@@ -148,7 +196,18 @@ async def get_account_logout(client_id: str, request: Request) -> JSONResponse:
     await accounts.logout(client_id, iphash)
     return api_response(True)
 
+
+
+def instrumented_api() -> FastAPI:
+    FastAPIInstrumentor.instrument_app(api)
+    return api
         
 if __name__ == "__main__":
-    FastAPIInstrumentor.instrument_app(api)
-    uvicorn.run(api)
+    if WEB_WORKERS > 1 and not (observability.PROMETHEUS_MULTIPROC_DIR and SESSION_BACKEND_URL):
+        observability.api_logger.error(f"WEB_WORKERS={WEB_WORKERS} requires PROMETHEUS_MULTIPROC_DIR and SESSION_BACKEND_URL to be set, starting a single worker...")
+        WEB_WORKERS = 1
+    
+    if WEB_WORKERS > 1:
+        uvicorn.run("server:instrumented_api", factory=True, workers=WEB_WORKERS)
+    else:
+        uvicorn.run(instrumented_api())
@@ -257,19 +257,19 @@ def select_answer_and_verify_next_question_builder(answer: str, is_correct: bool
         
         # Check if question and all answers are visible on site.
         question_data = await database.fetch_question(int(next_question_index))
-        if not await (page.get_by_text(question_data["question"])).is_visible():
+        if not await (page.get_by_text(question_data.question)).is_visible():
             observability.test_logger.critical(f"Question content is not visible on the site after loading next question: {next_question_index}")
             return False
         observability.test_logger.debug(f"The question content is visible on the site.")
         
         answers_content = []
-        if question_data["correct_answer"] in "TN":
+        if question_data.correct_answer in "TN":
             answers_content.append("Tak")
             answers_content.append("Nie")
         else:
-            answers_content.append(question_data["answers"]["A"])
-            answers_content.append(question_data["answers"]["B"])
-            answers_content.append(question_data["answers"]["C"])
+            answers_content.append(question_data.answers["A"])
+            answers_content.append(question_data.answers["B"])
+            answers_content.append(question_data.answers["C"])
             
         for answer_content in answers_content:
             if not await (page.get_by_text(answer_content)).is_visible():